@@ -6,37 +6,71 @@ import socket
 import logging
 import logging.handlers
 import sys
-import select
 import contextlib
 import time
 import struct
 import json
 import random
+import collections
+import os
+import signal
+import errno
+import gc
+import re
+import fnmatch
+import bisect
+import itertools
+import threading
+import Queue
 
 import dpkt
 import gevent.server
 import gevent.queue
+import gevent.pool
 import gevent.monkey
+import gevent.event
+import gevent.lock
+import gevent.socket
+import gevent.pywsgi
 
 
 LOGGER = logging.getLogger('fqdns')
 
-ERROR_NO_DATA = 11
+STALE_ANSWER_TTL = 30 # rfc8767
 SO_MARK = 36
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 OUTBOUND_MARK = 0
 OUTBOUND_IP = None
+EDNS_PAYLOAD_SIZE = 1232 # advertised to upstreams and downstreams, 0 to disable edns0
+ROTATED_SOCKET_LINGER = 10 # seconds to keep receiving late responses after socket rotated out
+DOMAIN_FILES_CHECK_INTERVAL = 5 # seconds between checking modification time of domain list files
+RECORD_TYPE_CHOICES = ['A', 'AAAA', 'CNAME', 'MX', 'NS', 'PTR', 'SOA', 'SRV', 'TXT']
+CACHE_SNAPSHOT_INTERVAL = 60 # seconds between saving cached answers to disk
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+DEFAULT_HEDGE_DELAY = 0.1 # seconds to wait for upstream never measured before asking the next one
 
 
 def main():
     global OUTBOUND_MARK
     global OUTBOUND_IP
-    gevent.monkey.patch_all(dns=gevent.version_info[0] >= 1, thread=False)
+    global EDNS_PAYLOAD_SIZE
     argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument(
+        '--engine', help='gevent-monkey patches the standard library, gevent leaves it alone for embedding',
+        choices=['gevent-monkey', 'gevent'], default='gevent-monkey')
     argument_parser.add_argument('--log-file')
     argument_parser.add_argument('--log-level', choices=['INFO', 'DEBUG'], default='INFO')
     argument_parser.add_argument('--outbound-mark', help='for example 0xcafe, set to every packet send out',
                                  default='0')
     argument_parser.add_argument('--outbound-ip', help='the ip address for every packet send out')
+    argument_parser.add_argument('--udp-sockets', help='number of udp sockets shared by all upstream queries',
+                                 default=8, type=int)
+    argument_parser.add_argument(
+        '--edns-payload-size', help='largest udp response accepted from upstream and sent to downstream, '
+                                    'advertised with edns0, 0 to disable', default=EDNS_PAYLOAD_SIZE, type=int)
+    argument_parser.add_argument('--tcp-connect-timeout', help='in seconds', default=1, type=float)
+    argument_parser.add_argument('--tcp-idle-timeout', help='close idle upstream tcp connection after, in seconds',
+                                 default=30, type=float)
     sub_parsers = argument_parser.add_subparsers()
     resolve_parser = sub_parsers.add_parser('resolve', help='start as dns client')
     resolve_parser.add_argument('domain', help='one or more domain names to query', nargs='+')
@@ -46,12 +80,32 @@ def main():
         '--strategy', help='anti-GFW strategy, for UDP only', default='pick-right',
         choices=['pick-first', 'pick-later', 'pick-right', 'pick-right-later', 'pick-all'])
     resolve_parser.add_argument(
-        '--wrong-answer', help='wrong answer forged by GFW, for UDP only', action='append')
+        '--wrong-answer', help='wrong answer forged by GFW, ip or cidr, for UDP only', action='append')
     resolve_parser.add_argument('--timeout', help='in seconds', default=1, type=float)
     resolve_parser.add_argument('--server-type', default='udp', choices=['udp', 'tcp'])
-    resolve_parser.add_argument('--record-type', default='A', choices=['A', 'TXT'])
+    resolve_parser.add_argument('--record-type', default='A', choices=RECORD_TYPE_CHOICES)
     resolve_parser.add_argument('--retry', default=1, type=int)
     resolve_parser.set_defaults(handler=resolve)
+    bulk_resolve_parser = sub_parsers.add_parser(
+        'bulk-resolve', help='resolve domain list of any size, one json line per domain written to stdout')
+    bulk_resolve_parser.add_argument('input', help='file of one domain per line, - for stdin', nargs='?', default='-')
+    bulk_resolve_parser.add_argument(
+        '--at', help='one or more dns servers', default=[], action='append')
+    bulk_resolve_parser.add_argument(
+        '--strategy', help='anti-GFW strategy, for UDP only', default='pick-right',
+        choices=['pick-first', 'pick-later', 'pick-right', 'pick-right-later', 'pick-all'])
+    bulk_resolve_parser.add_argument(
+        '--wrong-answer', help='wrong answer forged by GFW, ip or cidr, for UDP only', action='append')
+    bulk_resolve_parser.add_argument('--timeout', help='in seconds', default=1, type=float)
+    bulk_resolve_parser.add_argument('--server-type', default='udp', choices=['udp', 'tcp'])
+    bulk_resolve_parser.add_argument('--record-type', default='A', choices=RECORD_TYPE_CHOICES)
+    bulk_resolve_parser.add_argument('--retry', default=3, type=int)
+    bulk_resolve_parser.add_argument(
+        '--backoff', help='seconds before first retry of a domain, doubled for each next retry',
+        default=0.5, type=float)
+    bulk_resolve_parser.add_argument(
+        '--concurrency', help='max domains being resolved at the same time', default=256, type=int)
+    bulk_resolve_parser.set_defaults(handler=bulk_resolve)
     discover_parser = sub_parsers.add_parser('discover', help='resolve black listed domain to discover wrong answers')
     discover_parser.add_argument('--at', help='dns server', default='8.8.8.8:53')
     discover_parser.add_argument('--timeout', help='in seconds', default=1, type=float)
@@ -60,6 +114,22 @@ def main():
     discover_parser.add_argument(
         '--domain', help='black listed domain such as twitter.com', default=[], action='append')
     discover_parser.set_defaults(handler=discover)
+    benchmark_parser = sub_parsers.add_parser(
+        'benchmark', help='measure dns server against local fake upstream with GFW forging answers')
+    benchmark_parser.add_argument(
+        '--strategy', help='anti-GFW strategy to compare, all by default', default=[], action='append',
+        choices=['pick-first', 'pick-later', 'pick-right', 'pick-right-later', 'pick-all'])
+    benchmark_parser.add_argument('--qps', help='target queries per second', default=1000, type=int)
+    benchmark_parser.add_argument('--duration', help='in seconds, for each strategy', default=5, type=float)
+    benchmark_parser.add_argument('--names', help='number of distinct domains queried', default=10000, type=int)
+    benchmark_parser.add_argument('--zipf', help='exponent of zipf distribution of domains', default=1.1, type=float)
+    benchmark_parser.add_argument('--latency', help='upstream latency, in seconds', default=0.02, type=float)
+    benchmark_parser.add_argument('--loss', help='upstream udp loss rate', default=0, type=float)
+    benchmark_parser.add_argument(
+        '--forge-rate', help='fraction of domains GFW forges answer for', default=0.3, type=float)
+    benchmark_parser.add_argument('--fallback-timeout', help='in seconds', default=1, type=float)
+    benchmark_parser.add_argument('--cache-size', help='0 to measure upstream resolving', default=0, type=int)
+    benchmark_parser.set_defaults(handler=benchmark)
     serve_parser = sub_parsers.add_parser('serve', help='start as dns server')
     serve_parser.add_argument('--listen', help='local address bind to', default='*:53')
     serve_parser.add_argument(
@@ -70,6 +140,12 @@ def main():
         '--hosted-domain', help='the domain a.com will be transformed to a.com.b.com', default=[], action='append')
     serve_parser.add_argument(
         '--hosted-at', help='the domain b.com will host a.com.b.com', default='fqrouter.com')
+    serve_parser.add_argument(
+        '--china-domain-file', help='one domain per line or dnsmasq server=/a.com/ip lines, replaces builtin list, '
+                                    'reloaded on change or SIGHUP', default=[], action='append')
+    serve_parser.add_argument(
+        '--hosted-domain-file', help='one domain per line, replaces builtin list, reloaded on change or SIGHUP',
+        default=[], action='append')
     serve_parser.add_argument(
         '--direct', help='direct forward to first upstream via UDP', action='store_true')
     serve_parser.add_argument(
@@ -79,14 +155,85 @@ def main():
         '--enable-hosted-domain', help='otherwise hosted domain will not query with suffix hosted-at',
         action='store_true')
     serve_parser.add_argument(
-        '--fallback-timeout', help='fallback from udp to tcp after timeout, in seconds', default=1)
+        '--fallback-timeout', help='fallback from udp to tcp after timeout, in seconds', default=1, type=float)
     serve_parser.add_argument(
         '--strategy', help='anti-GFW strategy, for UDP only', default='pick-right',
         choices=['pick-first', 'pick-later', 'pick-right', 'pick-right-later', 'pick-all'])
+    serve_parser.add_argument(
+        '--upstream-selection', help='all: query all upstreams at once, '
+                                     'hedged: query the best one first, then others if it is slower than usual',
+        default='all', choices=['all', 'hedged'])
+    serve_parser.add_argument(
+        '--wrong-answer', help='wrong answer forged by GFW in addition to builtin ones, ip or cidr',
+        default=[], action='append')
+    serve_parser.add_argument(
+        '--wrong-answer-file', help='wrong answers discovered in background are saved here and loaded on start')
+    serve_parser.add_argument(
+        '--discover-interval', help='probe one black listed domain for new wrong answers every this many seconds, '
+                                    '0 to disable', default=0, type=float)
+    serve_parser.add_argument(
+        '--discover-domain', help='black listed domain to probe such as twitter.com', default=[], action='append')
+    serve_parser.add_argument(
+        '--cache-size', help='max number of answers cached, 0 to disable cache', default=4096, type=int)
+    serve_parser.add_argument(
+        '--cache-max-ttl', help='cap of upstream ttl when caching, in seconds', default=86400, type=int)
+    serve_parser.add_argument(
+        '--serve-stale', help='answer with expired cached answer while refreshing it in background, '
+                              'for at most this many seconds after expiry', default=0, type=int)
+    serve_parser.add_argument(
+        '--cache-failure-ttl', help='answer servfail at once for this many seconds after failing to resolve a name',
+        default=5, type=int)
+    serve_parser.add_argument(
+        '--prefetch-names', help='track this many most queried names, refreshing their cached answers '
+                                 'in background before expiry, 0 to disable', default=0, type=int)
+    serve_parser.add_argument(
+        '--prefetch-fraction', help='refresh when less than this fraction of ttl remains', default=0.1, type=float)
+    serve_parser.add_argument(
+        '--cache-file', help='cached answers and upstream stats are saved here periodically and on exit, '
+                             'loaded in background on start')
+    serve_parser.add_argument(
+        '--cache-snapshot-interval', help='in seconds', default=CACHE_SNAPSHOT_INTERVAL, type=int)
+    serve_parser.add_argument(
+        '--workers', help='number of worker processes sharing the listen address via SO_REUSEPORT',
+        default=1, type=int)
+    serve_parser.add_argument(
+        '--tcp-connections', help='max downstream tcp connections on the listen address, 0 to only listen udp',
+        default=1024, type=int)
+    serve_parser.add_argument(
+        '--tcp-client-idle-timeout', help='close idle downstream tcp connection after, in seconds',
+        default=10, type=float)
+    serve_parser.add_argument(
+        '--max-concurrent-requests', help='requests beyond this being handled are answered with servfail at once, '
+                                          '0 means unlimited', default=1000, type=int)
+    serve_parser.add_argument(
+        '--max-upstream-queries', help='names being resolved from upstreams at most, '
+                                       'cache misses beyond this are answered with servfail, 0 means unlimited',
+        default=500, type=int)
+    serve_parser.add_argument(
+        '--client-rate', help='requests per second allowed for each client ip, refused beyond, 0 means unlimited',
+        default=0, type=float)
+    serve_parser.add_argument(
+        '--client-burst', help='requests a client ip can send at once before --client-rate applies',
+        default=100, type=int)
+    serve_parser.add_argument('--query-log-file', help='one record per downstream query, written in background')
+    serve_parser.add_argument(
+        '--query-log-format', help='json lines or fixed size binary records',
+        default='json', choices=['json', 'binary'])
+    serve_parser.add_argument(
+        '--query-log-sample-rate', help='fraction of queries logged', default=1, type=float)
+    serve_parser.add_argument(
+        '--metrics-listen', help='serve prometheus metrics over http at this address, for example 127.0.0.1:9153, '
+                                 'worker N listens at port + N')
     serve_parser.set_defaults(handler=serve)
     args = argument_parser.parse_args()
+    if 'gevent-monkey' == args.engine:
+        gevent.monkey.patch_all(dns=gevent.version_info[0] >= 1, thread=False)
     OUTBOUND_MARK = eval(args.outbound_mark)
     OUTBOUND_IP = args.outbound_ip
+    UDP_TRANSPORT.pool_size = args.udp_sockets
+    EDNS_PAYLOAD_SIZE = args.edns_payload_size
+    TCP_TRANSPORT.connect_timeout = args.tcp_connect_timeout
+    TCP_TRANSPORT.idle_timeout = args.tcp_idle_timeout
     log_level = getattr(logging, args.log_level)
     logging.basicConfig(stream=sys.stdout, level=log_level, format='%(asctime)s %(levelname)s %(message)s')
     if args.log_file:
@@ -96,13 +243,20 @@ def main():
         handler.setLevel(log_level)
         logging.getLogger('fqdns').addHandler(handler)
     return_value = args.handler(**{k: getattr(args, k) for k in vars(args) \
-                                   if k not in {'handler', 'log_file', 'log_level', 'outbound_mark', 'outbound_ip'}})
+                                   if k not in {'handler', 'engine', 'log_file', 'log_level', 'outbound_mark',
+                                                'outbound_ip', 'udp_sockets', 'edns_payload_size',
+                                                'tcp_connect_timeout', 'tcp_idle_timeout'}})
     sys.stderr.write(json.dumps(return_value))
     sys.stderr.write('\n')
 
 
-def serve(listen, upstream, china_upstream, hosted_domain, hosted_at,
-          direct, enable_china_domain, enable_hosted_domain, fallback_timeout, strategy):
+def serve(listen, upstream, china_upstream, hosted_domain, hosted_at, china_domain_file, hosted_domain_file,
+          direct, enable_china_domain, enable_hosted_domain, fallback_timeout, strategy, upstream_selection,
+          wrong_answer, wrong_answer_file, discover_interval, discover_domain,
+          cache_size, cache_max_ttl, serve_stale, cache_failure_ttl, prefetch_names, prefetch_fraction, cache_file,
+          cache_snapshot_interval, workers, tcp_connections, tcp_client_idle_timeout, max_concurrent_requests,
+          max_upstream_queries, client_rate, client_burst, query_log_file, query_log_format, query_log_sample_rate,
+          metrics_listen):
     address = parse_ip_colon_port(listen)
     upstreams = [parse_ip_colon_port(e) for e in upstream] or \
                 [('8.8.8.8', 53), ('208.67.222.222', 5353)]
@@ -111,85 +265,879 @@ def serve(listen, upstream, china_upstream, hosted_domain, hosted_at,
                           [('114.114.114.114', 53), ('114.114.115.115', 53)]
     else:
         china_upstreams = []
+        china_domain_file = []
     if enable_hosted_domain:
-        hosted_domains = hosted_domain or HOSTED_DOMAINS()
+        hosted_domains = set(hosted_domain) if hosted_domain or hosted_domain_file else HOSTED_DOMAINS()
     else:
         hosted_domains = set()
-    server = DNSServer(address, upstreams, china_upstreams,
-                       hosted_domains, hosted_at, direct, fallback_timeout, strategy)
-    LOGGER.info('dns server started at %r, forwarding to %r', address, upstreams)
+        hosted_domain_file = []
+    wrong_answers = compile_wrong_answers(wrong_answer)
+
+    def create_server(worker_index=0):
+        listener = create_reuse_port_socket(address) if workers > 1 else address
+        server = DNSServer(listener, upstreams, china_upstreams,
+                           hosted_domains, hosted_at, direct, fallback_timeout, strategy,
+                           DNSCache(cache_size, cache_max_ttl, serve_stale, cache_failure_ttl),
+                           wrong_answers=wrong_answers, upstream_selection=upstream_selection,
+                           max_concurrent_requests=max_concurrent_requests,
+                           max_upstream_queries=max_upstream_queries)
+        if client_rate:
+            server.rate_limiter = ClientRateLimiter(client_rate, client_burst)
+        if tcp_connections:
+            tcp_listener = create_reuse_port_socket(address, socket.SOCK_STREAM) if workers > 1 else address
+            tcp_server = DNSTCPServer(tcp_listener, server, tcp_connections, tcp_client_idle_timeout)
+            tcp_server.start()
+            server.tcp_server = tcp_server
+        if china_domain_file or hosted_domain_file:
+            DomainFilesReloader(server, china_domain_file, hosted_domain_file, hosted_domains).start()
+        if wrong_answer_file or discover_interval:
+            WrongAnswersDiscoverer(
+                server, wrong_answer_file, wrong_answer, discover_domain or DISCOVER_DOMAINS,
+                discover_interval, probing=0 == worker_index).start() # other workers only reload the file
+        if prefetch_names:
+            server.prefetcher = Prefetcher(server, prefetch_names, prefetch_fraction)
+        if cache_file:
+            path = '%s.%s' % (cache_file, worker_index) if workers > 1 else cache_file
+            server.snapshot = CacheSnapshot(path, server, cache_snapshot_interval)
+            server.snapshot.start()
+        if query_log_file:
+            path = '%s.%s' % (query_log_file, worker_index) if workers > 1 else query_log_file
+            server.query_log = QueryLog(path, query_log_format, query_log_sample_rate)
+        if metrics_listen:
+            metrics_ip, metrics_port = parse_ip_colon_port(metrics_listen)
+            INFLIGHT_RESOLUTIONS.get_value = lambda: len(server.inflight)
+            CACHE_ENTRIES.get_value = lambda: len(server.cache.entries)
+            metrics_server = gevent.pywsgi.WSGIServer(
+                (metrics_ip, metrics_port + worker_index), serve_metrics, log=None)
+            metrics_server.start()
+            LOGGER.info('metrics server started at %r', metrics_server.address)
+        return server
+
+    if workers > 1:
+        supervise(workers, create_server)
+    else:
+        server = create_server()
+        handle_signal(signal.SIGTERM, server.stop)
+        run_server(server)
+
+
+def run_server(server):
+    LOGGER.info('dns server started at %r, forwarding to %r', server.address, server.upstreams)
     try:
         server.serve_forever()
     except:
         LOGGER.exception('dns server failed')
     finally:
+        if server.snapshot:
+            try:
+                server.snapshot.save()
+            except:
+                LOGGER.exception('failed to save cache snapshot on exit')
         LOGGER.info('dns server stopped')
 
 
+def supervise(workers_count, create_server):
+    workers = {} # pid => worker index
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def reload(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+    for worker_index in range(workers_count):
+        workers[fork_worker(create_server, worker_index)] = worker_index
+    LOGGER.info('supervising %s workers: %s', workers_count, sorted(workers))
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError, e:
+            if errno.EINTR == e.errno:
+                continue
+            raise
+        if pid not in workers:
+            continue
+        worker_index = workers.pop(pid)
+        if not stopping:
+            LOGGER.error('worker %s exited with status %s, restarting it', pid, status)
+            time.sleep(1) # do not spin if worker keeps dying
+            workers[fork_worker(create_server, worker_index)] = worker_index
+    LOGGER.info('all workers stopped')
+
+
+def fork_worker(create_server, worker_index):
+    pid = gevent.fork()
+    if pid:
+        return pid
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # supervisor will send SIGTERM
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN) # forwarded by supervisor, handled only if there are domain files
+        server = create_server(worker_index)
+        handle_signal(signal.SIGTERM, server.stop)
+        run_server(server)
+    finally:
+        os._exit(0)
+
+
+def handle_signal(signum, handler):
+    install_signal_handler = getattr(gevent, 'signal_handler', None) or getattr(gevent, 'signal')
+    install_signal_handler(signum, handler)
+
+
+def create_reuse_port_socket(address, type=socket.SOCK_DGRAM):
+    sock = gevent.socket.socket(family=socket.AF_INET, type=type)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    if socket.SOCK_STREAM == type:
+        sock.listen(gevent.server.StreamServer.backlog)
+    return sock
+
+
+class DNSTCPServer(gevent.server.StreamServer):
+    # length prefixed queries of one connection are answered concurrently, in the order they are resolved
+    def __init__(self, listener, dns_server, max_connections=1024, idle_timeout=10, pipelined_queries=32):
+        super(DNSTCPServer, self).__init__(listener, spawn=gevent.pool.Pool(max_connections))
+        self.dns_server = dns_server
+        self.idle_timeout = idle_timeout
+        self.pipelined_queries = pipelined_queries
+
+    def handle(self, sock, address):
+        sock.settimeout(self.idle_timeout)
+        queries = gevent.pool.Pool(self.pipelined_queries) # stop reading more when full
+        lock = gevent.lock.Semaphore()
+        try:
+            while True:
+                try:
+                    request_size, = struct.unpack('>H', recv_exactly(sock, 2))
+                except socket.timeout:
+                    if queries:
+                        continue
+                    return # idle
+                except socket.error:
+                    return
+                try:
+                    raw_request = recv_exactly(sock, request_size)
+                except socket.error:
+                    return # including timeout in the middle of a message
+                queries.wait_available()
+                if self.dns_server.handlers.full(): # bounded together with udp requests
+                    REJECTED_REQUESTS.labels('busy').inc()
+                    response = build_error_response(raw_request, dpkt.dns.DNS_RCODE_SERVFAIL)
+                    queries.spawn(self.send, sock, lock, response, address)
+                else:
+                    queries.add(self.dns_server.handlers.spawn(self.answer, sock, lock, raw_request, address))
+        finally:
+            queries.join(timeout=self.idle_timeout) # client might only close its sending side
+            sock.close()
+
+    def answer(self, sock, lock, raw_request, address):
+        try:
+            response = self.dns_server.handle_request(raw_request, address, max_size=65535)
+        except:
+            LOGGER.exception('failed to handle tcp request from %s:%s' % address)
+            return
+        self.send(sock, lock, response, address)
+
+    def send(self, sock, lock, response, address):
+        if not response:
+            return
+        try:
+            with lock:
+                sock.sendall(struct.pack('>H', len(response)) + response)
+        except socket.error:
+            LOGGER.debug('failed to answer tcp client %s:%s' % address, exc_info=1)
+
+
 class DNSServer(gevent.server.DatagramServer):
     def __init__(self, address, upstreams, china_upstreams,
-                 hosted_domains, hosted_at, direct, fallback_timeout, strategy):
+                 hosted_domains, hosted_at, direct, fallback_timeout, strategy, cache=None, china_domains=None,
+                 wrong_answers=None, upstream_selection='all', max_concurrent_requests=1000,
+                 max_upstream_queries=500):
         super(DNSServer, self).__init__(address)
         self.upstreams = upstreams
         self.china_upstreams = china_upstreams
         self.hosted_domains = hosted_domains
+        self.china_domains = CHINA_DOMAIN_INDEX if china_domains is None else china_domains
+        self.wrong_answers = wrong_answers or BUILTIN_WRONG_ANSWER_SET
         self.hosted_at = hosted_at
         self.direct = direct
         self.fallback_timeout = fallback_timeout
         self.strategy = strategy
+        self.upstream_selection = upstream_selection
+        self.cache = cache or DNSCache(0)
+        self.inflight = {} # cache_key => greenlet resolving it
+        self.max_upstream_queries = max_upstream_queries
+        self.handlers = gevent.pool.Pool(max_concurrent_requests or None)
+        self.rate_limiter = None
+        self.query_log = None
+        self.snapshot = None
+        self.prefetcher = None
+        self.tcp_server = None
+
+    def do_handle(self, raw_request, address):
+        if self.handlers.full(): # fail fast, silence only makes clients retry and pile up more
+            REJECTED_REQUESTS.labels('busy').inc()
+            response = build_error_response(raw_request, dpkt.dns.DNS_RCODE_SERVFAIL)
+            if response:
+                self.sendto(response, address)
+        else:
+            self.handlers.spawn(self.handle, raw_request, address)
 
     def handle(self, raw_request, address):
-        request = dpkt.dns.DNS(raw_request)
-        LOGGER.debug('received downstream request from %s: %s' % (str(address), repr(request)))
-        domains = [question.name for question in request.qd if dpkt.dns.DNS_A == question.type]
-        if len(domains) == 1 and not self.direct:
-            domain = domains[0]
-            response = dpkt.dns.DNS(raw_request)
-            if not self.query_smartly(domain, response):
-                return # let client retry
+        response = self.handle_request(raw_request, address)
+        if response:
+            self.sendto(response, address)
+
+    def handle_request(self, raw_request, address, max_size=None):
+        # shared by udp and tcp, max size of response is decided by edns0 for udp
+        started_at = time.time()
+        if self.rate_limiter and not self.rate_limiter.allow(address[0]):
+            REJECTED_REQUESTS.labels('rate').inc()
+            return build_error_response(raw_request, dpkt.dns.DNS_RCODE_REFUSED)
+        question = None if self.direct else parse_simple_query(raw_request)
+        if question and question[1] not in FORWARDED_TYPES: # fast path, no dpkt
+            domain, question_type, question_end, payload_size = question
+            REQUESTS.labels(question_type).inc()
+            answers, outcome = self.query_smartly(domain, question_type)
+            if answers:
+                response = build_response(raw_request, question_end, question_type, answers, payload_size, max_size)
+            else:
+                response = build_error_response(raw_request, dpkt.dns.DNS_RCODE_SERVFAIL)
+                outcome = 'overload' if 'overload' == outcome else 'fail'
+            answers_count = len(answers or ())
         else:
-            response = self.query_first_upstream_via_udp(request)
-        LOGGER.debug('forward to downstream response to %s: %s' % (str(address), repr(response)))
-        self.sendto(str(response), address)
+            domain, question_type, answers_count, outcome, response = self.handle_unusual(
+                raw_request, address, max_size)
+        if self.query_log:
+            self.query_log.log(started_at, address[0], domain, question_type, outcome, answers_count)
+        return response
 
-    def query_smartly(self, domain, response):
+    def handle_unusual(self, raw_request, address, max_size):
+        try:
+            request = dpkt.dns.DNS(raw_request)
+        except dpkt.UnpackError: # junk should not cost a traceback each
+            REJECTED_REQUESTS.labels('malformed').inc()
+            return '', 0, 0, 'fail', build_error_response(raw_request, dpkt.dns.DNS_RCODE_FORMERR)
+        for question in request.qd:
+            REQUESTS.labels(question.type).inc()
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('received downstream request from %s: %s' % (str(address), repr(request)))
+        domain, question_type = (request.qd[0].name, request.qd[0].type) if request.qd else ('', 0)
+        if 1 == len(request.qd) and dpkt.dns.DNS_IN == request.qd[0].cls and \
+                question_type not in FORWARDED_TYPES and not self.direct:
+            answers, outcome = self.query_smartly(domain, question_type)
+            if not answers:
+                return domain, question_type, 0, 'overload' if 'overload' == outcome else 'fail', \
+                    build_error_response(raw_request, dpkt.dns.DNS_RCODE_SERVFAIL)
+            simple_request = str(dpkt.dns.DNS(id=request.id, op=request.op, qd=request.qd))
+            payload_size = max([record.cls for record in request.ar if dpkt.dns.DNS_OPT == record.type] or [0])
+            response = build_response(
+                simple_request, len(simple_request), question_type, answers, payload_size, max_size)
+            answers_count = len(answers)
+        else:
+            outcome = 'forward'
+            try:
+                response = self.query_first_upstream_via_udp(request)
+            except SocketTimeout:
+                return domain, question_type, 0, 'fail', build_error_response(
+                    raw_request, dpkt.dns.DNS_RCODE_SERVFAIL)
+            answers_count, = struct.unpack('>H', response[6:8])
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('forward to downstream response to %s: %r' % (str(address), response))
+        return domain, question_type, answers_count, outcome, response
+
+    def query_smartly(self, domain, question_type=dpkt.dns.DNS_A):
         selected_upstreams = self.china_upstreams if \
-            self.china_upstreams and is_china_domain(domain) else self.upstreams
+            self.china_upstreams and domain in self.china_domains else self.upstreams
         if domain.startswith('ignore-hosted-domain.'):
             querying_domain = domain.replace('ignore-hosted-domain.', '')
         else:
             querying_domain = '%s.%s' % (domain, self.hosted_at) if domain in self.hosted_domains else domain
-        answers = resolve(dpkt.dns.DNS_A, [querying_domain], 'udp',
-                          selected_upstreams, self.fallback_timeout, strategy=self.strategy).get(querying_domain)
+        cache_key = (querying_domain, question_type, tuple(selected_upstreams))
+        answers, fresh = self.cache.get(cache_key)
+        if answers and fresh:
+            CACHE_HITS.inc()
+            if self.prefetcher:
+                self.prefetcher.record_hit(cache_key, querying_domain, selected_upstreams)
+            return answers, 'hit'
+        elif answers:
+            CACHE_STALE_HITS.inc()
+            self.resolve_coalesced(cache_key, querying_domain, selected_upstreams) # refresh in background
+            return answers, 'stale'
+        elif self.cache.has_failed(cache_key): # retries of client should not wait for upstreams again
+            CACHE_FAILURE_HITS.inc()
+            return None, 'fail'
+        else:
+            CACHE_MISSES.inc()
+            greenlet = self.resolve_coalesced(cache_key, querying_domain, selected_upstreams)
+            if not greenlet:
+                REJECTED_REQUESTS.labels('upstream').inc()
+                return None, 'overload'
+            return greenlet.get(), 'miss'
+
+    def resolve_smartly(self, querying_domain, record_type, selected_upstreams):
+        selected_upstreams = UPSTREAM_HEALTH.available(selected_upstreams)
+        if POISONING_HISTORY.is_poisoned(querying_domain):
+            answers = None # udp only gets forged answers recently
+        elif 'hedged' == self.upstream_selection:
+            answers = resolve_hedged(
+                record_type, querying_domain, UPSTREAM_HEALTH.rank(selected_upstreams),
+                self.fallback_timeout, self.strategy, self.wrong_answers)
+        else:
+            answers = resolve_answers(
+                record_type, [querying_domain], 'udp', selected_upstreams, self.fallback_timeout,
+                strategy=self.strategy, wrong_answer=self.wrong_answers).get(querying_domain)
+        if answers and isinstance(answers[0], list): # pick-all picked more than one response
+            positive_answers = collections.OrderedDict(
+                answer for response_answers in answers for answer in response_answers
+                if not isinstance(answer[0], NegativeAnswer)).items()
+            answers = positive_answers or answers[0] # negative answer can not be mixed with others in one response
         if not answers:
-            answers = resolve(
-                dpkt.dns.DNS_A, [querying_domain], 'tcp',
-                selected_upstreams, self.fallback_timeout * 2).get(querying_domain)
-            if not answers:
-                return False
-        response.set_qr(True)
-        response.an = [dpkt.dns.DNS.RR(
-            name=domain, type=dpkt.dns.DNS_A, ttl=3600,
-            rlen=len(socket.inet_aton(answer)),
-            rdata=socket.inet_aton(answer)) for answer in answers]
-        return True
+            TCP_FALLBACKS.inc()
+            answers = resolve_answers(
+                record_type, [querying_domain], 'tcp', selected_upstreams, self.fallback_timeout * 2,
+                wrong_answer=self.wrong_answers).get(querying_domain)
+        return answers
+
+    def resolve_coalesced(self, cache_key, querying_domain, selected_upstreams):
+        greenlet = self.inflight.get(cache_key)
+        if not greenlet:
+            if self.max_upstream_queries and len(self.inflight) >= self.max_upstream_queries:
+                return None # too many names being resolved, upstreams or the way to them is struggling
+            greenlet = gevent.spawn(self.resolve_and_cache, cache_key, querying_domain, selected_upstreams)
+            self.inflight[cache_key] = greenlet
+            greenlet.link(lambda g: self.inflight.pop(cache_key, None))
+        return greenlet
+
+    def resolve_and_cache(self, cache_key, querying_domain, selected_upstreams):
+        record_type = cache_key[1]
+        try:
+            answers = self.resolve_smartly(querying_domain, record_type, selected_upstreams)
+        except:
+            LOGGER.exception('failed to resolve smartly: %s' % querying_domain)
+            answers = None
+        if answers:
+            self.cache.set(cache_key, answers)
+        else:
+            self.cache.set_failure(cache_key)
+        return answers
 
     def query_first_upstream_via_udp(self, request):
-        sock = create_socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        with contextlib.closing(sock):
-            sock.sendto(str(request), self.upstreams[0])
-            return dpkt.dns.DNS(sock.recv(512))
+        with UDP_TRANSPORT.send(request, self.upstreams[0]) as responses:
+            return receive(responses, time.time() + self.fallback_timeout) # passed through as it is
+
+
+class DNSCache(object):
+    def __init__(self, max_entries, max_ttl=86400, stale_ttl=0, failure_ttl=0):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.stale_ttl = stale_ttl
+        self.failure_ttl = failure_ttl
+        self.entries = collections.OrderedDict() # least recently used first
+        self.failures = collections.OrderedDict() # key => failed until, earliest first
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if not entry:
+            return None, False
+        answers, stored_at, expires_at = entry
+        now = time.time()
+        if now >= expires_at + self.stale_ttl:
+            return None, False
+        self.entries[key] = entry
+        if now >= expires_at:
+            return [(answer, STALE_ANSWER_TTL) for answer, ttl in answers], False
+        age = int(now - stored_at)
+        return [(answer, max(ttl - age, 0)) for answer, ttl in answers], True
+
+    def set(self, key, answers):
+        if self.max_entries <= 0 or not answers:
+            return
+        ttl = min(min(ttl for answer, ttl in answers), self.max_ttl)
+        if ttl <= 0:
+            return
+        now = time.time()
+        self.failures.pop(key, None)
+        self.entries.pop(key, None)
+        self.entries[key] = (answers, now, now + ttl)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set_failure(self, key):
+        if self.max_entries <= 0 or self.failure_ttl <= 0:
+            return
+        self.failures.pop(key, None)
+        self.failures[key] = time.time() + self.failure_ttl
+        while len(self.failures) > self.max_entries:
+            self.failures.popitem(last=False)
+
+    def has_failed(self, key):
+        failed_until = self.failures.get(key)
+        if failed_until is None:
+            return False
+        if time.time() >= failed_until:
+            del self.failures[key]
+            return False
+        return True
+
+    def restore(self, entries):
+        # entries is taken over, what got cached meanwhile is fresher and stays most recently used
+        if self.max_entries <= 0:
+            return
+        for key, entry in self.entries.items():
+            entries.pop(key, None)
+            entries[key] = entry
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        self.entries = entries
+
+    def remove_answers(self, wrong_answers):
+        for key, (answers, stored_at, expires_at) in self.entries.items():
+            if any(answer in wrong_answers for answer, ttl in answers):
+                del self.entries[key]
+
+
+class ClientRateLimiter(object):
+    # token bucket per client ip, buckets refilled to full are forgotten when there are too many clients
+    def __init__(self, rate, burst, max_clients=65536):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self.buckets = {} # client ip => (tokens, updated at)
+
+    def allow(self, client_ip):
+        now = time.time()
+        if client_ip in self.buckets:
+            tokens, updated_at = self.buckets[client_ip]
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        else:
+            if len(self.buckets) >= self.max_clients:
+                self.trim(now)
+            tokens = self.burst
+        if tokens < 1:
+            self.buckets[client_ip] = (tokens, now)
+            return False
+        self.buckets[client_ip] = (tokens - 1, now)
+        return True
+
+    def trim(self, now):
+        self.buckets = {client_ip: (tokens, updated_at) for client_ip, (tokens, updated_at) in self.buckets.iteritems()
+                        if tokens + (now - updated_at) * self.rate < self.burst}
+        if len(self.buckets) >= self.max_clients: # flood from too many addresses, start over
+            self.buckets = {}
+
+
+class Prefetcher(object):
+    # hits are counted for the most queried names only, answers of those close to expiry are resolved
+    # again in background, so no client pays the upstream latency when they expire
+    def __init__(self, server, max_names, fraction, min_hits=3, concurrency=8):
+        self.server = server
+        self.max_names = max_names
+        self.fraction = fraction
+        self.min_hits = min_hits
+        self.counts = {} # cache_key => hits, halved on every trim to follow recent popularity
+        self.pool = gevent.pool.Pool(concurrency)
+
+    def record_hit(self, cache_key, querying_domain, selected_upstreams):
+        hits = self.counts.get(cache_key, 0) + 1
+        self.counts[cache_key] = hits
+        if len(self.counts) > 2 * self.max_names:
+            self.trim()
+        if hits < self.min_hits or self.pool.full() or cache_key in self.server.inflight:
+            return
+        entry = self.server.cache.entries.get(cache_key)
+        if not entry:
+            return
+        answers, stored_at, expires_at = entry
+        if expires_at - time.time() > self.fraction * (expires_at - stored_at):
+            return
+        greenlet = self.server.resolve_coalesced(cache_key, querying_domain, selected_upstreams)
+        if greenlet:
+            PREFETCHES.inc()
+            self.pool.add(greenlet)
+
+    def trim(self): # amortized, sorting once every max_names new names
+        top = sorted(self.counts.iteritems(), key=lambda item: item[1], reverse=True)[:self.max_names]
+        self.counts = dict((cache_key, hits / 2) for cache_key, hits in top if hits > 1)
+
+
+class CacheSnapshot(object):
+    MAGIC = 'FQDNS-SNAPSHOT-2\n'
+    UPSTREAM_RECORD = struct.Struct('>c4sHdddd') # U, ip, port, srtt, rttvar, loss, forged
+    CACHE_RECORD = struct.Struct('>cddHBBB') # C, stored at, expires at, type, upstreams, answers, name length
+    SERVER = struct.Struct('>4sH')
+    ANSWER = struct.Struct('>cIH') # 4, 6, R(ecord) or N(egative), ttl, length of what follows
+    YIELD_EVERY = 500 # entries, queries are not answered while packing or unpacking
+    YIELD_SECONDS = 0.001 # sleep(0) does not get sockets polled
+
+    def __init__(self, path, server, interval=CACHE_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.server = server
+        self.cache = server.cache
+        self.interval = interval
+
+    def start(self):
+        gevent.spawn(self.load) # listener is bound already, answers from upstream until loaded
+        if self.interval:
+            gevent.spawn(self.run)
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.save()
+            except:
+                LOGGER.exception('failed to save cache snapshot to %s' % self.path)
+
+    def save(self):
+        started_at = time.time()
+        chunks = [self.MAGIC]
+        for (ip, port), stats in UPSTREAM_HEALTH.stats.items():
+            if stats.srtt is not None:
+                chunks.append(self.UPSTREAM_RECORD.pack(
+                    'U', socket.inet_aton(ip), port, stats.srtt, stats.rttvar, stats.loss, stats.forged))
+        count = 0
+        for key in self.cache.entries.keys(): # copying keys is much faster than items, entries can change on yield
+            entry = self.cache.entries.get(key)
+            if not entry:
+                continue
+            (domain, record_type, upstreams), (answers, stored_at, expires_at) = key, entry
+            if started_at >= expires_at + self.cache.stale_ttl:
+                continue
+            answers = answers[:255]
+            chunks.append(self.CACHE_RECORD.pack(
+                'C', stored_at, expires_at, record_type, len(upstreams), len(answers), len(domain)))
+            chunks.extend(self.SERVER.pack(socket.inet_aton(ip), port) for ip, port in upstreams)
+            chunks.append(domain)
+            for answer, ttl in answers:
+                kind, packed_answer = self.pack_answer(answer)
+                chunks.append(self.ANSWER.pack(kind, ttl, len(packed_answer)))
+                chunks.append(packed_answer)
+            count += 1
+            if 0 == count % self.YIELD_EVERY:
+                gevent.sleep(self.YIELD_SECONDS)
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'wb') as f:
+            f.write(''.join(chunks))
+        os.rename(tmp_path, self.path)
+        LOGGER.info('saved %s cached answers to %s in %.3f seconds' % (count, self.path, time.time() - started_at))
+
+    def load(self):
+        started_at = time.time()
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError, e:
+            if errno.ENOENT != e.errno:
+                LOGGER.exception('failed to read cache snapshot from %s' % self.path)
+            return
+        if not data.startswith(self.MAGIC):
+            LOGGER.error('ignore cache snapshot %s of unknown format' % self.path)
+            return
+        entries = collections.OrderedDict()
+        wrong_answers = self.server.wrong_answers # might be discovered after the snapshot was saved
+        records_count = 0
+        offset = len(self.MAGIC)
+        gc_enabled = gc.isenabled()
+        gc.disable() # loaded entries are not cyclic, collecting the growing heap again and again stalls queries
+        try:
+            while offset < len(data):
+                if 'U' == data[offset]:
+                    kind, ip, port, srtt, rttvar, loss, forged = self.UPSTREAM_RECORD.unpack_from(data, offset)
+                    offset += self.UPSTREAM_RECORD.size
+                    stats = UPSTREAM_HEALTH.get_stats((socket.inet_ntoa(ip), port))
+                    if stats.srtt is None: # not measured since start
+                        stats.srtt, stats.rttvar, stats.loss, stats.forged = srtt, rttvar, loss, forged
+                    continue
+                kind, stored_at, expires_at, record_type, upstreams_count, answers_count, domain_length = \
+                    self.CACHE_RECORD.unpack_from(data, offset)
+                if 'C' != kind:
+                    raise Exception('unknown record %r at %s' % (kind, offset))
+                offset += self.CACHE_RECORD.size
+                upstreams = []
+                for i in range(upstreams_count):
+                    ip, port = self.SERVER.unpack_from(data, offset)
+                    offset += self.SERVER.size
+                    upstreams.append((socket.inet_ntoa(ip), port))
+                domain = data[offset:offset + domain_length]
+                offset += domain_length
+                answers = []
+                wrong = False
+                for i in range(answers_count):
+                    kind, ttl, length = self.ANSWER.unpack_from(data, offset)
+                    offset += self.ANSWER.size + length
+                    packed_answer = data[offset - length:offset]
+                    wrong = wrong or ('4' == kind and packed_answer in wrong_answers)
+                    answers.append((self.unpack_answer(kind, packed_answer), ttl))
+                if started_at < expires_at + self.cache.stale_ttl and not wrong:
+                    entries[(domain, record_type, tuple(upstreams))] = (answers, stored_at, expires_at)
+                records_count += 1
+                if 0 == records_count % self.YIELD_EVERY:
+                    gevent.sleep(self.YIELD_SECONDS)
+        except:
+            LOGGER.exception('cache snapshot %s is corrupted, keep what was read before' % self.path)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.cache.restore(entries)
+        LOGGER.info('loaded %s cached answers from %s in %.3f seconds' % (
+            len(entries), self.path, time.time() - started_at))
+
+    def pack_answer(self, answer):
+        if isinstance(answer, NegativeAnswer):
+            return 'N', chr(answer.rcode) + pack_name(answer.soa_name) + answer.soa_rdata
+        if isinstance(answer, tuple):
+            name, record_type, rdata = answer
+            return 'R', struct.pack('>H', record_type) + pack_name(name) + rdata
+        if ':' in answer:
+            return '6', socket.inet_pton(socket.AF_INET6, answer)
+        return '4', socket.inet_aton(answer)
+
+    def unpack_answer(self, kind, packed_answer):
+        if '4' == kind:
+            return socket.inet_ntoa(packed_answer)
+        if '6' == kind:
+            return socket.inet_ntop(socket.AF_INET6, packed_answer)
+        if 'R' == kind:
+            name, offset = read_name(packed_answer, 2)
+            return name, struct.unpack('>H', packed_answer[:2])[0], packed_answer[offset:]
+        if 'N' == kind:
+            name, offset = read_name(packed_answer, 1)
+            return NegativeAnswer(ord(packed_answer[0]), name, packed_answer[offset:])
+        raise Exception('unknown answer %r' % kind)
+
+
+class QueryLog(object):
+    BINARY_RECORD = struct.Struct('>d4sHBBfB') # time, client ip, question type, outcome, answers, ms, name length
+    OUTCOMES = {'hit': 0, 'stale': 1, 'miss': 2, 'forward': 3, 'fail': 4, 'overload': 5}
+
+    def __init__(self, path, format='json', sample_rate=1, max_pending=10000):
+        self.path = path
+        self.format = format
+        self.sample_rate = sample_rate
+        self.records = Queue.Queue(max_pending)
+        writer = threading.Thread(target=self.write_forever, name='query-log-writer')
+        writer.daemon = True
+        writer.start()
+
+    def log(self, started_at, client_ip, domain, question_type, outcome, answers_count):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self.records.put_nowait(
+                (started_at, time.time() - started_at, client_ip, domain, question_type, outcome, answers_count))
+        except Queue.Full:
+            QUERY_LOG_DROPPED.inc()
+
+    def write_forever(self):
+        format_record = self.format_binary if 'binary' == self.format else self.format_json
+        with open(self.path, 'ab') as f:
+            while True:
+                record = self.records.get()
+                try:
+                    f.write(format_record(*record))
+                except:
+                    LOGGER.exception('failed to write query log')
+                if self.records.empty():
+                    f.flush()
+
+    def format_json(self, started_at, elapsed, client_ip, domain, question_type, outcome, answers_count):
+        return '%s\n' % json.dumps({
+            'time': round(started_at, 3), 'client': client_ip, 'domain': domain,
+            'type': RECORD_TYPE_NAMES.get(question_type, question_type), 'outcome': outcome,
+            'answers': answers_count, 'ms': round(elapsed * 1000, 3)}, separators=(',', ':'))
+
+    def format_binary(self, started_at, elapsed, client_ip, domain, question_type, outcome, answers_count):
+        domain = domain[:255]
+        return self.BINARY_RECORD.pack(
+            started_at, socket.inet_aton(client_ip), question_type, self.OUTCOMES[outcome], min(answers_count, 255),
+            elapsed * 1000, len(domain)) + domain
+
+
+class Metrics(object):
+    def __init__(self):
+        self.families = []
+
+    def counter(self, name, help, label_names=()):
+        return self.add(MetricFamily(name, help, 'counter', label_names, Counter))
+
+    def gauge(self, name, help, label_names=()):
+        return self.add(MetricFamily(name, help, 'gauge', label_names, Gauge))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.add(MetricFamily(name, help, 'histogram', label_names, lambda: Histogram(buckets)))
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            family.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricFamily(object):
+    def __init__(self, name, help, type, label_names, create):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = label_names
+        self.create = create
+        self.children = {} # label values => metric, values are formatted only when rendering
+
+    def labels(self, *label_values):
+        metric = self.children.get(label_values)
+        if metric is None:
+            metric = self.children[label_values] = self.create()
+        return metric
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.type))
+        for label_values, metric in self.children.items():
+            labels = ['%s="%s"' % (name, format_label_value(value))
+                      for name, value in zip(self.label_names, label_values)]
+            metric.render(self.name, labels, lines)
+
+
+def format_labels(labels):
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def format_label_value(value):
+    if isinstance(value, tuple): # server
+        return '%s:%s' % value
+    if isinstance(value, int): # record type
+        return RECORD_TYPE_NAMES.get(value, value)
+    return value
+
+
+class Counter(object):
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name, labels, lines):
+        lines.append('%s%s %s' % (name, format_labels(labels), self.value))
+
+
+class Gauge(Counter):
+    __slots__ = ['get_value']
+
+    def __init__(self):
+        super(Gauge, self).__init__()
+        self.get_value = None
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self, name, labels, lines):
+        lines.append('%s%s %s' % (name, format_labels(labels), self.get_value() if self.get_value else self.value))
+
+
+class Histogram(object):
+    __slots__ = ['buckets', 'counts', 'sum']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels, lines):
+        cumulative_count = 0
+        for bucket, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative_count += count
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels + ['le="%s"' % bucket]), cumulative_count))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), self.sum))
+        lines.append('%s_count%s %s' % (name, format_labels(labels), cumulative_count))
+
+
+def serve_metrics(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [METRICS.render()]
+
+
+RECORD_TYPE_NAMES = {getattr(dpkt.dns, 'DNS_%s' % name): name
+                     for name in ['A', 'NS', 'CNAME', 'SOA', 'PTR', 'MX', 'TXT', 'AAAA', 'SRV']}
+METRICS = Metrics()
+REQUESTS = METRICS.counter('fqdns_requests_total', 'downstream requests by question type', ('type',))
+CACHE_HITS = METRICS.counter('fqdns_cache_hits_total', 'answered from fresh cache entry').labels()
+CACHE_STALE_HITS = METRICS.counter('fqdns_cache_stale_hits_total', 'answered from expired cache entry').labels()
+CACHE_FAILURE_HITS = METRICS.counter(
+    'fqdns_cache_failure_hits_total', 'answered servfail as resolving the name failed just now').labels()
+CACHE_MISSES = METRICS.counter('fqdns_cache_misses_total', 'resolved from upstreams').labels()
+CACHE_ENTRIES = METRICS.gauge('fqdns_cache_entries', 'answers in cache').labels()
+REJECTED_REQUESTS = METRICS.counter(
+    'fqdns_rejected_requests_total', 'answered with servfail or refused without resolving', ('reason',))
+TCP_FALLBACKS = METRICS.counter('fqdns_tcp_fallbacks_total', 'udp got no right answer, retried over tcp').labels()
+UPSTREAM_QUERIES = METRICS.counter(
+    'fqdns_upstream_queries_total', 'queries sent to upstream', ('server', 'transport'))
+UPSTREAM_FAILURES = METRICS.counter(
+    'fqdns_upstream_failures_total', 'upstream queries timed out or failed', ('server', 'transport'))
+UPSTREAM_TIMEOUTS = METRICS.counter(
+    'fqdns_upstream_timeouts_total', 'upstream queries waited till timeout', ('server', 'transport'))
+UPSTREAM_CANCELLED = METRICS.counter(
+    'fqdns_upstream_cancelled_total', 'upstream queries stopped as another upstream answered', ('server', 'transport'))
+UPSTREAM_LATENCY = METRICS.histogram(
+    'fqdns_upstream_latency_seconds', 'time to get answer from upstream', ('server', 'transport'))
+WRONG_RESPONSES_REJECTED = METRICS.counter(
+    'fqdns_wrong_responses_rejected_total', 'forged responses rejected by pick-right strategies').labels()
+UPSTREAM_EJECTIONS = METRICS.counter(
+    'fqdns_upstream_ejections_total', 'upstream ejected after consecutive udp timeouts', ('server',))
+PREFETCHES = METRICS.counter(
+    'fqdns_prefetches_total', 'popular cached answers resolved again before expiry').labels()
+UDP_EARLY_RETURNS = METRICS.counter(
+    'fqdns_udp_early_returns_total', 'udp queries returned before timeout as nothing is expected to follow').labels()
+INFLIGHT_UPSTREAM_QUERIES = METRICS.gauge(
+    'fqdns_inflight_upstream_queries', 'greenlets querying upstream right now').labels()
+QUERY_LOG_DROPPED = METRICS.counter(
+    'fqdns_query_log_dropped_total', 'query log records dropped as writer can not keep up').labels()
+INFLIGHT_RESOLUTIONS = METRICS.gauge(
+    'fqdns_inflight_resolutions', 'distinct questions being resolved right now').labels()
 
 
 def resolve(record_type, domain, server_type, at, timeout, strategy='pick-right', wrong_answer=(), retry=1):
+    domains_answers = resolve_answers(record_type, domain, server_type, at, timeout, strategy, wrong_answer, retry)
+    return {domain: format_answers(answers) for domain, answers in domains_answers.items()}
+
+
+def resolve_answers(record_type, domain, server_type, at, timeout, strategy='pick-right', wrong_answer=(), retry=1):
+    # answers as cached and sent downstream, with wire format rdata
     if isinstance(record_type, basestring):
         record_type = getattr(dpkt.dns, 'DNS_%s' % record_type)
     servers = [parse_ip_colon_port(e) for e in at] or [('8.8.8.8', 53)]
+    wrong_answers = compile_wrong_answers(wrong_answer)
     domains = set(domain)
     domains_answers = {}
     for i in range(retry):
         domains_answers.update(resolve_once(
-            record_type, domains, server_type, servers, timeout, strategy, wrong_answer))
+            record_type, domains, server_type, servers, timeout, strategy, wrong_answers))
         domains = domains - set(domains_answers.keys())
         if domains:
             LOGGER.warn('did not finish resolving: %s' % domains)
@@ -198,7 +1146,62 @@ def resolve(record_type, domain, server_type, at, timeout, strategy='pick-right'
     return domains_answers
 
 
-def resolve_once(record_type, domains, server_type, servers, timeout, strategy, wrong_answer):
+def bulk_resolve(input, record_type, server_type, at, timeout, strategy, wrong_answer, retry, backoff, concurrency):
+    lines = sys.stdin if '-' == input else open(input)
+    domains = (domain for domain in (line.split('#')[0].strip() for line in lines) if domain)
+    resolved, negative, failed = 0, 0, 0
+    for domain, answers in resolve_stream(
+            record_type, domains, server_type, at, timeout, strategy, wrong_answer, retry, backoff, concurrency):
+        sys.stdout.write('%s\n' % json.dumps({'domain': domain, 'answers': answers}))
+        if not answers:
+            failed += 1
+        elif isinstance(answers[0][0], dict): # nxdomain or no data
+            negative += 1
+        else:
+            resolved += 1
+    return {'resolved': resolved, 'negative': negative, 'failed': failed}
+
+
+def resolve_stream(record_type, domains, server_type, at, timeout, strategy='pick-right', wrong_answer=(), retry=1,
+                   backoff=0.5, concurrency=256):
+    # domains can be any iterable, it is consumed as slots become free, (domain, answers) yielded as completed
+    if isinstance(record_type, basestring):
+        record_type = getattr(dpkt.dns, 'DNS_%s' % record_type)
+    servers = [parse_ip_colon_port(e) for e in at] or [('8.8.8.8', 53)]
+    wrong_answers = compile_wrong_answers(wrong_answer)
+    results = gevent.queue.Queue(concurrency) # not consumed fast enough blocks resolving more
+    pool = gevent.pool.Pool(concurrency)
+
+    def resolve_with_retry(domain):
+        answers = None
+        for i in range(retry):
+            if i:
+                gevent.sleep(backoff * (2 ** (i - 1)) * random.uniform(0.5, 1.5))
+            answers = resolve_once(
+                record_type, [domain], server_type, servers, timeout, strategy, wrong_answers).get(domain)
+            if answers:
+                break
+        results.put((domain, format_answers(answers or [])))
+
+    def feed():
+        for domain in domains:
+            pool.spawn(resolve_with_retry, domain) # blocks when concurrency reached
+        pool.join()
+        results.put(None)
+
+    feeder = gevent.spawn(feed)
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            yield result
+    finally:
+        feeder.kill(block=False)
+        pool.kill(block=False)
+
+
+def resolve_once(record_type, domains, server_type, servers, timeout, strategy, wrong_answers):
     greenlets = []
     queue = gevent.queue.Queue()
     try:
@@ -207,13 +1210,19 @@ def resolve_once(record_type, domains, server_type, servers, timeout, strategy,
                 server_ip, server_port = server
                 greenlets.append(gevent.spawn(
                     resolve_one, record_type, domain, server_type,
-                    server_ip, server_port, timeout - 0.1, strategy, wrong_answer, queue=queue))
+                    server_ip, server_port, timeout - 0.1, strategy, wrong_answers, queue=queue))
+        finished = gevent.spawn(gevent.joinall, list(greenlets))
+        finished.link(lambda greenlet: queue.put(None)) # no need to wait for timeout if all failed early
+        greenlets.append(finished)
         started_at = time.time()
         domains_answers = {}
         remaining_timeout = started_at + timeout - time.time()
         while remaining_timeout > 0:
             try:
-                domain, answers = queue.get(timeout=remaining_timeout)
+                domain_answers = queue.get(timeout=remaining_timeout)
+                if not domain_answers:
+                    return domains_answers
+                domain, answers = domain_answers
                 domains_answers[domain] = answers
                 if len(domains_answers) == len(domains):
                     return domains_answers
@@ -226,6 +1235,107 @@ def resolve_once(record_type, domains, server_type, servers, timeout, strategy,
             greenlet.kill(block=False)
 
 
+def resolve_hedged(record_type, domain, servers, timeout, strategy, wrong_answers):
+    # queries already sent are left running after the answer, so slow or dead upstreams still get measured
+    queue = gevent.queue.Queue()
+    deadline = time.time() + timeout
+    finished = 0
+    for i, server in enumerate(servers):
+        server_ip, server_port = server
+        greenlet = gevent.spawn(resolve_one, record_type, domain, 'udp', server_ip, server_port,
+                                timeout, strategy, wrong_answers, queue=queue)
+        greenlet.link(lambda greenlet: queue.put(None)) # put after the answers, if any
+        if i == len(servers) - 1:
+            wait_until = deadline
+        else:
+            wait_until = min(time.time() + UPSTREAM_HEALTH.get_hedge_delay(server), deadline)
+        while True:
+            try:
+                domain_answers = queue.get(timeout=max(wait_until - time.time(), 0))
+            except gevent.queue.Empty:
+                break # slower than usual, ask next upstream as well
+            if domain_answers:
+                return domain_answers[1]
+            finished += 1
+            if finished == i + 1:
+                return None # all failed early, no need to wait for timeout before tcp fallback
+    return None
+
+
+class UpstreamHealth(object):
+    def __init__(self, alpha=0.125, failures_to_eject=3, min_eject_seconds=5, max_eject_seconds=300):
+        self.alpha = alpha
+        self.failures_to_eject = failures_to_eject
+        self.min_eject_seconds = min_eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.stats = {} # server => UpstreamStats
+
+    def get_stats(self, server):
+        stats = self.stats.get(server)
+        if not stats:
+            stats = self.stats[server] = UpstreamStats(self.min_eject_seconds)
+        return stats
+
+    def record_rtt(self, server, rtt):
+        stats = self.get_stats(server)
+        if stats.srtt is None:
+            stats.srtt = rtt
+            stats.rttvar = rtt / 2
+        else: # same as tcp rto estimation
+            stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+            stats.srtt = (1 - self.alpha) * stats.srtt + self.alpha * rtt
+        stats.loss *= 1 - self.alpha
+        stats.failures = 0
+        stats.eject_seconds = self.min_eject_seconds
+
+    def record_loss(self, server):
+        stats = self.get_stats(server)
+        stats.loss = (1 - self.alpha) * stats.loss + self.alpha
+        stats.failures += 1
+        if stats.failures >= self.failures_to_eject:
+            LOGGER.error('eject upstream %s:%s for %s seconds' % (server[0], server[1], stats.eject_seconds))
+            UPSTREAM_EJECTIONS.labels(server).inc()
+            stats.ejected_until = time.time() + stats.eject_seconds
+            stats.eject_seconds = min(stats.eject_seconds * 2, self.max_eject_seconds)
+
+    def record_forged(self, server, forged):
+        stats = self.get_stats(server)
+        stats.forged = (1 - self.alpha) * stats.forged + (self.alpha if forged else 0)
+
+    def available(self, servers):
+        now = time.time()
+        available_servers = [server for server in servers if self.get_stats(server).ejected_until <= now]
+        return available_servers or servers # re-probed when ejection expires
+
+    def rank(self, servers):
+        return sorted(servers, key=lambda server: self.get_stats(server).get_score())
+
+    def get_hedge_delay(self, server):
+        stats = self.get_stats(server)
+        if stats.srtt is None:
+            return DEFAULT_HEDGE_DELAY
+        return stats.srtt + 4 * stats.rttvar # roughly p95 of rtt
+
+
+class UpstreamStats(object):
+    def __init__(self, eject_seconds):
+        self.srtt = None # never measured, rank it first to measure it
+        self.rttvar = 0
+        self.loss = 0
+        self.forged = 0
+        self.failures = 0 # consecutive
+        self.ejected_until = 0
+        self.eject_seconds = eject_seconds
+
+    def get_score(self):
+        if self.srtt is None:
+            return float('inf') if self.failures else 0
+        return self.srtt * (1 + 4 * self.loss) * (1 + self.forged)
+
+
+UPSTREAM_HEALTH = UpstreamHealth()
+
+
 def parse_ip_colon_port(ip_colon_port):
     if not isinstance(ip_colon_port, basestring):
         return ip_colon_port
@@ -238,175 +1348,704 @@ def parse_ip_colon_port(ip_colon_port):
     return '' if '*' == server_ip else server_ip, server_port
 
 
-def resolve_one(record_type, domain, server_type, server_ip, server_port, timeout, strategy, wrong_answer, queue=None):
+def resolve_one(record_type, domain, server_type, server_ip, server_port, timeout, strategy, wrong_answers,
+                queue=None):
     answers = []
+    server = (server_ip, server_port)
+    UPSTREAM_QUERIES.labels(server, server_type).inc()
+    INFLIGHT_UPSTREAM_QUERIES.inc()
+    started_at = time.time()
+    cancelled = False
+    failed = False
     try:
-        LOGGER.info('%s resolve %s at %s:%s' % (server_type, domain, server_ip, server_port))
         if 'udp' == server_type:
-            wrong_answers = set(wrong_answer) if wrong_answer else set()
-            wrong_answers |= BUILTIN_WRONG_ANSWERS()
             answers = resolve_over_udp(
                 record_type, domain, server_ip, server_port, timeout, strategy, wrong_answers)
         elif 'tcp' == server_type:
-            answers = resolve_over_tcp(record_type, domain, server_ip, server_port, timeout)
+            answers = resolve_over_tcp(record_type, domain, server_ip, server_port, timeout, wrong_answers)
+            failed = not answers
         else:
             LOGGER.error('unsupported server type: %s' % server_type)
+    except gevent.GreenletExit:
+        cancelled = True
     except:
         LOGGER.exception('failed to resolve one: %s' % domain)
+        failed = True
+    finally:
+        INFLIGHT_UPSTREAM_QUERIES.dec()
+    elapsed = time.time() - started_at
+    if answers:
+        UPSTREAM_LATENCY.labels(server, server_type).observe(elapsed)
+    elif cancelled:
+        UPSTREAM_CANCELLED.labels(server, server_type).inc()
+    elif elapsed >= timeout:
+        UPSTREAM_TIMEOUTS.labels(server, server_type).inc()
+        UPSTREAM_FAILURES.labels(server, server_type).inc()
+    elif failed: # udp returning nothing before timeout is left to tcp fallback on purpose
+        UPSTREAM_FAILURES.labels(server, server_type).inc()
     if answers and queue:
         queue.put((domain, answers))
-    LOGGER.info('%s resolved %s at %s:%s => %s' % (server_type, domain, server_ip, server_port, json.dumps(answers)))
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('%s resolved %s at %s:%s => %s' % (
+            server_type, domain, server_ip, server_port, json.dumps(format_answers(answers))))
     return answers
 
 
-def resolve_over_tcp(record_type, domain, server_ip, server_port, timeout):
-    sock = create_socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-    with contextlib.closing(sock):
-        sock.setblocking(0)
-        request = dpkt.dns.DNS(id=get_transaction_id(), qd=[dpkt.dns.DNS.Q(name=domain, type=record_type)])
-        LOGGER.debug('send request: %s' % repr(request))
-        sock.settimeout(1)
+def resolve_over_tcp(record_type, domain, server_ip, server_port, timeout, wrong_answers=None):
+    request = dpkt.dns.DNS(id=get_transaction_id(), qd=[dpkt.dns.DNS.Q(name=domain, type=record_type)])
+    LOGGER.debug('send request: %r', request)
+    try:
+        response = parse_response(TCP_TRANSPORT.query(request, (server_ip, server_port), timeout))
+    except SocketTimeout:
+        return []
+    except (socket.error, ValueError):
+        LOGGER.error('failed to query %s:%s over tcp due to %s' % (server_ip, server_port, sys.exc_info()[1]))
+        return []
+    if dpkt.dns.DNS_A == record_type and is_negative_response(response):
+        return list_answers(response, record_type) # only trusted over tcp
+    if not is_right_response(response, wrong_answers or BUILTIN_WRONG_ANSWER_SET, record_type):
+        return [] # filter opendns "nxdomain"
+    return list_answers(response, record_type)
+
+
+class TCPTransport(object):
+    def __init__(self, connections_per_server=2, pipelined_queries=32, connect_timeout=1, idle_timeout=30):
+        self.connections_per_server = connections_per_server
+        self.pipelined_queries = pipelined_queries # open another connection when exceeded
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.connections = {} # server => [TCPConnection]
+
+    def query(self, request, server, timeout):
+        deadline = time.time() + timeout
+        connection = self.pick_connection(server)
         try:
-            sock.connect((server_ip, server_port))
-        except gevent.GreenletExit:
-            return []
+            return connection.query(request, deadline)
+        except ConnectionClosed:
+            if not connection.reused:
+                raise
+        # server closed the idle keep-alive connection under our feet, retry once with a new one
+        return self.pick_connection(server, reuse=False).query(request, deadline)
+
+    def pick_connection(self, server, reuse=True):
+        connections = [c for c in self.connections.get(server, ()) if not c.closed]
+        self.connections[server] = connections
+        if reuse and connections:
+            connection = min(connections, key=lambda c: len(c.waiters))
+            if len(connection.waiters) < self.pipelined_queries or len(connections) >= self.connections_per_server:
+                connection.reused = True
+                return connection
+        connection = TCPConnection(server, self.connect_timeout, self.idle_timeout)
+        connections.append(connection)
+        return connection
+
+
+class TCPConnection(object):
+    def __init__(self, server, connect_timeout, idle_timeout):
+        self.server = server
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.sock = None
+        self.closed = False
+        self.reused = False
+        self.waiters = {} # transaction id => AsyncResult
+        self.lock = gevent.lock.Semaphore()
+
+    def query(self, request, deadline):
+        while request.id in self.waiters:
+            request.id = get_transaction_id()
+        response = gevent.event.AsyncResult()
+        self.waiters[request.id] = response
+        try:
+            data = str(request)
+            with self.lock:
+                if self.closed:
+                    raise ConnectionClosed('connection to %s:%s closed' % self.server)
+                if not self.sock:
+                    self.connect(min(self.connect_timeout, deadline - time.time()))
+                self.sock.sendall(struct.pack('>H', len(data)) + data)
+            return response.get(timeout=max(deadline - time.time(), 0))
+        except gevent.Timeout:
+            raise SocketTimeout()
+        except socket.error:
+            self.close()
+            raise
+        finally:
+            self.waiters.pop(request.id, None)
+
+    def connect(self, timeout):
+        sock = create_socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.server)
         except:
-            LOGGER.exception('failed to connect to %s:%s due to %s' % (server_ip, server_port, sys.exc_info()[1]))
-            return []
-        sock.settimeout(None)
-        data = str(request)
-        sock.send(struct.pack('>h', len(data)) + data)
+            sock.close()
+            self.closed = True
+            raise
+        sock.settimeout(self.idle_timeout)
+        self.sock = sock
+        gevent.spawn(self.receive_forever)
+
+    def receive_forever(self):
         try:
-            ins, outs, errors = select.select([sock], [], [sock], timeout)
-        except gevent.GreenletExit:
-            return []
-        if errors:
-            LOGGER.error('failed to read dns response')
-            return []
-        if not ins:
-            return []
-        rfile = sock.makefile('r', 512)
-        data = rfile.read(2)
-        data = rfile.read(struct.unpack('>h', data)[0])
-        response = dpkt.dns.DNS(data)
-        if not is_right_response(response, BUILTIN_WRONG_ANSWERS()): # filter opendns "nxdomain"
-            response = None
-        if response:
-            if dpkt.dns.DNS_A == record_type:
-                return list_ipv4_addresses(response)
-            else:
-                return [answer.rdata for answer in response.an]
-        else:
-            return []
+            while True:
+                try:
+                    data = recv_exactly(self.sock, struct.unpack('>H', recv_exactly(self.sock, 2))[0])
+                except socket.timeout:
+                    if self.waiters:
+                        continue
+                    LOGGER.debug('close idle tcp connection to %s:%s' % self.server)
+                    return
+                transaction_id, = struct.unpack('>H', data[:2])
+                response = self.waiters.get(transaction_id)
+                if response:
+                    response.set(data)
+        except (socket.error, struct.error):
+            LOGGER.debug('tcp connection to %s:%s failed' % self.server, exc_info=1)
+        finally:
+            self.close()
 
+    def close(self):
+        if self.closed and not self.sock:
+            return
+        self.closed = True
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        for response in self.waiters.values():
+            response.set_exception(ConnectionClosed('connection to %s:%s closed' % self.server))
 
-def resolve_over_udp(record_type, domain, server_ip, server_port, timeout, strategy, wrong_answers):
-    sock = create_socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-    with contextlib.closing(sock):
-        sock.setblocking(0)
-        request = dpkt.dns.DNS(id=get_transaction_id(), qd=[dpkt.dns.DNS.Q(name=domain, type=record_type)])
-        LOGGER.debug('send request: %s' % repr(request))
-        sock.sendto(str(request), (server_ip, server_port))
-        if dpkt.dns.DNS_A == record_type:
-            responses = pick_responses(sock, timeout, strategy, wrong_answers)
-            if len(responses) == 1:
-                return list_ipv4_addresses(responses[0])
-            elif len(responses) > 1:
-                return [list_ipv4_addresses(response) for response in responses]
-            else:
-                return []
+
+TCP_TRANSPORT = TCPTransport()
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionClosed('connection closed by peer')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def resolve_over_udp(record_type, domain, server_ip, server_port, timeout, strategy, wrong_answers,
+                     learn_poisoning=True):
+    request = dpkt.dns.DNS(id=get_transaction_id(), qd=[dpkt.dns.DNS.Q(name=domain, type=record_type)])
+    if EDNS_PAYLOAD_SIZE: # otherwise large answers truncated by upstream
+        request.ar = [dpkt.dns.DNS.RR(type=dpkt.dns.DNS_OPT, cls=EDNS_PAYLOAD_SIZE)]
+    LOGGER.debug('send request: %r', request)
+    with UDP_TRANSPORT.send(request, (server_ip, server_port)) as responses:
+        responses = pick_responses(
+            responses, timeout, strategy, wrong_answers, (server_ip, server_port),
+            domain if learn_poisoning else None, record_type)
+        if len(responses) == 1:
+            return list_answers(responses[0], record_type)
+        elif len(responses) > 1:
+            return [list_answers(response, record_type) for response in responses]
         else:
-            try:
-                response = dpkt.dns.DNS(receive(sock, time.time() + timeout))
-                LOGGER.debug('received response: %s' % repr(response))
-                return [answer.rdata for answer in response.an]
-            except SocketTimeout:
-                return []
+            return []
 
 
 def get_transaction_id():
     return random.randint(1, 65535)
 
 
-def receive(sock, deadline, size=512):
+def receive(responses, deadline):
     remaining_timeout = deadline - time.time()
-    while remaining_timeout > 0:
-        LOGGER.debug('wait for max %s seconds' % remaining_timeout)
-        try:
-            ins, outs, errors = select.select([sock], [], [sock], remaining_timeout)
-        except gevent.GreenletExit:
-            raise SocketTimeout()
-        if errors:
-            LOGGER.error('failed to receive')
-            raise Exception('failed to receive')
-        if sock not in ins:
-            raise SocketTimeout()
+    if remaining_timeout <= 0:
+        raise SocketTimeout()
+    LOGGER.debug('wait for max %s seconds', remaining_timeout)
+    try:
+        return responses.get(timeout=remaining_timeout)
+    except gevent.queue.Empty:
+        raise SocketTimeout()
+
+
+class UDPTransport(object):
+    def __init__(self, pool_size=8, queries_per_socket=1024):
+        self.pool_size = pool_size
+        self.queries_per_socket = queries_per_socket # rotate to new source port after that many queries
+        self.sockets = [] # [sock, queries sent]
+        self.waiters = {} # (transaction id, question name, question type, server) => [queue]
+
+    @contextlib.contextmanager
+    def send(self, request, server):
+        if len(request.qd) == 1:
+            key = (request.id, request.qd[0].name.lower(), request.qd[0].type, server)
+        else:
+            key = (request.id, None, None, server)
+        responses = gevent.queue.Queue()
+        self.waiters.setdefault(key, []).append(responses)
         try:
-            return sock.recv(size)
-        except socket.error, e:
-            if ERROR_NO_DATA == e[0]:
-                remaining_timeout = deadline - time.time()
+            self.pick_socket().sendto(str(request), server)
+            yield responses
+        finally:
+            waiters = self.waiters[key]
+            waiters.remove(responses)
+            if not waiters:
+                del self.waiters[key]
+
+    def pick_socket(self):
+        if len(self.sockets) < self.pool_size:
+            slot = [self.open_socket(), 0]
+            self.sockets.append(slot)
+        else:
+            slot = random.choice(self.sockets)
+            if slot[1] >= self.queries_per_socket:
+                gevent.spawn_later(ROTATED_SOCKET_LINGER, slot[0].close)
+                slot[:] = [self.open_socket(), 0]
+        slot[1] += 1
+        return slot[0]
+
+    def open_socket(self):
+        sock = create_socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        gevent.spawn(self.receive_forever, sock)
+        return sock
+
+    def receive_forever(self, sock):
+        buffer = bytearray(max(EDNS_PAYLOAD_SIZE, 512)) # reused for every response of this socket
+        while True:
+            try:
+                size, server = sock.recvfrom_into(buffer)
+                data = str(buffer[:size])
+            except socket.error:
+                LOGGER.debug('stop receiving from udp socket', exc_info=1)
+                self.sockets = [slot for slot in self.sockets if slot[0] is not sock]
+                return
+            try:
+                transaction_id, question_name, question_type, question_end = parse_question(data)
+            except ValueError:
+                LOGGER.debug('drop malformed response from %s:%s' % server)
                 continue
-            raise
-    raise SocketTimeout()
+            for responses in self.waiters.get((transaction_id, question_name, question_type, server), ()):
+                responses.put(data)
+
+
+UDP_TRANSPORT = UDPTransport()
+
+
+def parse_question(data):
+    try:
+        transaction_id, flags, question_count = struct.unpack('>HHH', data[:6])
+        if question_count != 1:
+            return transaction_id, None, None, 12
+        labels = []
+        offset = 12
+        length = ord(data[offset])
+        while length:
+            if length & 0xc0:
+                raise ValueError('compressed question name')
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+            length = ord(data[offset])
+        question_type, = struct.unpack('>H', data[offset + 1:offset + 3])
+    except (struct.error, IndexError):
+        raise ValueError('truncated dns packet')
+    return transaction_id, '.'.join(labels).lower(), question_type, offset + 5
+
+
+def parse_simple_query(data):
+    # standard query with exactly one IN question and optionally edns0, the rest goes through dpkt
+    if len(data) < 17:
+        return None
+    flags, question_count, answer_count, authority_count, additional_count = struct.unpack('>HHHHH', data[2:12])
+    if flags & 0xf800 or 1 != question_count or answer_count or authority_count or additional_count > 1:
+        return None # not query or not standard query
+    try:
+        transaction_id, question_name, question_type, question_end = parse_question(data)
+    except ValueError:
+        return None
+    if dpkt.dns.DNS_IN != struct.unpack('>H', data[question_end - 2:question_end])[0]:
+        return None
+    payload_size = 0
+    if additional_count: # opt record with root name
+        if question_end + 1 + RECORD_HEADER.size > len(data) or '\x00' != data[question_end]:
+            return None
+        record_type, payload_size, extended_flags, options_length = RECORD_HEADER.unpack_from(data, question_end + 1)
+        if dpkt.dns.DNS_OPT != record_type or extended_flags & 0xff0000: # only edns version 0
+            return None
+        if question_end + 1 + RECORD_HEADER.size + options_length != len(data):
+            return None
+        payload_size = max(payload_size, 512)
+    elif question_end != len(data):
+        return None
+    return question_name, question_type, question_end, payload_size
+
+
+def build_error_response(request, rcode):
+    if len(request) < 12:
+        return None
+    question = parse_simple_query(request)
+    question_end = question[2] if question else 12 # question of unusual request is not echoed
+    flags, = struct.unpack('>H', request[2:4])
+    flags = 0x8080 | (flags & 0x7900) | rcode # qr, ra, opcode and rd copied
+    header = struct.pack('>HHHHH', flags, 1 if question else 0, 0, 0, 0)
+    return ''.join([request[:2], header, request[12:question_end]])
+
+
+def build_response(request, question_end, question_type, answers, payload_size=0, max_size=None):
+    # payload size of downstream edns0, 0 means no edns0 and at most 512 bytes unless max size given
+    flags, = struct.unpack('>H', request[2:4])
+    flags = 0x8080 | (flags & 0x0100) # qr, ra, rd copied
+    answers_count, authorities_count = len(answers), 0
+    if isinstance(answers[0][0], NegativeAnswer):
+        (negative, ttl), = answers
+        flags |= negative.rcode
+        answers_count, authorities_count = 0, 1
+        records = [pack_name(negative.soa_name),
+                   RECORD_HEADER.pack(dpkt.dns.DNS_SOA, dpkt.dns.DNS_IN, ttl, len(negative.soa_rdata)),
+                   negative.soa_rdata]
+    elif dpkt.dns.DNS_A == question_type:
+        records = [A_RECORD_HEADER.pack(0xc00c, dpkt.dns.DNS_A, dpkt.dns.DNS_IN, ttl, 4) + socket.inet_aton(answer)
+                   for answer, ttl in answers] # 0xc00c points to question name
+    elif dpkt.dns.DNS_AAAA == question_type:
+        records = [A_RECORD_HEADER.pack(0xc00c, dpkt.dns.DNS_AAAA, dpkt.dns.DNS_IN, ttl, 16) +
+                   socket.inet_pton(socket.AF_INET6, answer) for answer, ttl in answers]
+    else:
+        records = [pack_name(name) + RECORD_HEADER.pack(record_type, dpkt.dns.DNS_IN, ttl, len(rdata)) + rdata
+                   for (name, record_type, rdata), ttl in answers] # cname chain kept as it is
+    additional_records = [EDNS_OPT_RECORD.pack(0, dpkt.dns.DNS_OPT, EDNS_PAYLOAD_SIZE or 512, 0, 0)] \
+        if payload_size else []
+    header = struct.pack('>HHHHH', flags, 1, answers_count, authorities_count, len(additional_records))
+    response = ''.join([request[:2], header, request[12:question_end]] + records + additional_records)
+    if len(response) > (max_size or max(payload_size, 512)): # tc set, client retries over tcp
+        header = struct.pack('>HHHHH', flags | 0x0200, 1, 0, 0, len(additional_records))
+        response = ''.join([request[:2], header, request[12:question_end]] + additional_records)
+    return response
+
+
+A_RECORD_HEADER = struct.Struct('>HHHIH')
+RECORD_HEADER = struct.Struct('>HHIH')
+EDNS_OPT_RECORD = struct.Struct('>BHHIH') # root name, type, payload size, extended rcode and flags, options length
+FORWARDED_TYPES = (251, 252, dpkt.dns.DNS_ANY) # ixfr, axfr and any are not resolved smartly
+
+
+def parse_response(data):
+    try:
+        transaction_id, flags, question_count, answer_count, authority_count = struct.unpack('>HHHHH', data[:10])
+        offset = 12
+        for i in range(question_count):
+            offset = read_name(data, offset)[1] + 4
+        sections = []
+        for count in (answer_count, authority_count):
+            records = []
+            for i in range(count):
+                name, offset = read_name(data, offset)
+                record_type, record_class, ttl, rdata_length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if offset + rdata_length > len(data):
+                    raise ValueError('truncated dns packet')
+                if record_type in NAME_RDATA_LAYOUTS:
+                    rdata = expand_rdata(data, record_type, offset, rdata_length)
+                else:
+                    rdata = data[offset:offset + rdata_length]
+                offset += rdata_length
+                records.append(DNSRecord(name, record_type, ttl, rdata))
+            sections.append(records)
+    except (struct.error, IndexError):
+        raise ValueError('truncated dns packet')
+    return DNSResponse(transaction_id, flags & 0xf, sections[0], sections[1], bool(flags & 0x0200))
+
+
+DNSResponse = collections.namedtuple('DNSResponse', 'id rcode an ns truncated')
+DNSRecord = collections.namedtuple('DNSRecord', 'name type ttl rdata') # same fields used of dpkt rr
+
+
+def read_name(data, offset):
+    labels = []
+    end = None
+    for i in range(128): # pointers can loop
+        length = ord(data[offset])
+        if not length:
+            return '.'.join(labels), (offset + 1 if end is None else end)
+        if length & 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('>H', data[offset:offset + 2])[0] & 0x3fff
+        else:
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+    raise ValueError('too many labels')
+
+
+def pack_name(name):
+    return ''.join('%s%s' % (chr(len(label)), label) for label in name.split('.') if label) + '\x00'
+
+
+def expand_rdata(data, record_type, offset, length):
+    # names in rdata might point into the upstream response, copied uncompressed to be sent in other responses
+    fixed_length, names_count = NAME_RDATA_LAYOUTS[record_type]
+    chunks = [data[offset:offset + fixed_length]]
+    name_offset = offset + fixed_length
+    for i in range(names_count):
+        name, name_offset = read_name(data, name_offset)
+        chunks.append(pack_name(name))
+    chunks.append(data[name_offset:offset + length]) # numbers after soa names
+    return ''.join(chunks)
+
+
+NAME_RDATA_LAYOUTS = { # record type => (fixed length before names, names count)
+    dpkt.dns.DNS_NS: (0, 1), dpkt.dns.DNS_CNAME: (0, 1), dpkt.dns.DNS_PTR: (0, 1), 39: (0, 1), # dname
+    dpkt.dns.DNS_MX: (2, 1), dpkt.dns.DNS_SRV: (6, 1), dpkt.dns.DNS_SOA: (0, 2)}
+NegativeAnswer = collections.namedtuple('NegativeAnswer', 'rcode soa_name soa_rdata')
 
 
-def pick_responses(sock, timeout, strategy, wrong_answers):
+def pick_responses(responses, timeout, strategy, wrong_answers, server=None, domain=None,
+                   record_type=dpkt.dns.DNS_A):
     picked_responses = []
     started_at = time.time()
     deadline = started_at + timeout
     remaining_timeout = deadline - time.time()
+    received_any = False
+    forged_seen = False
+    responses_after_picked = 0
     while remaining_timeout > 0:
         try:
-            response = dpkt.dns.DNS(receive(sock, deadline))
+            response = parse_response(receive(responses, deadline))
+        except ValueError:
+            LOGGER.debug('ignored malformed response')
+            continue
         except SocketTimeout:
+            if server and time.time() >= deadline: # not killed because others answered
+                if not received_any:
+                    UPSTREAM_HEALTH.record_loss(server)
+                if domain:
+                    POISONING_HISTORY.record_full_wait(server, domain, responses_after_picked)
+                    if forged_seen and not picked_responses:
+                        POISONING_HISTORY.record_poisoned(domain)
             return picked_responses
-        LOGGER.debug('received response: %s' % repr(response))
+        if server and not received_any:
+            UPSTREAM_HEALTH.record_rtt(server, time.time() - started_at)
+        received_any = True
+        if response.truncated: # larger than edns payload size, tcp fallback will get it without waiting for timeout
+            LOGGER.debug('received truncated response')
+            return picked_responses
+        if picked_responses:
+            responses_after_picked += 1
+        LOGGER.debug('received response: %r', response)
+        if dpkt.dns.DNS_A == record_type and is_negative_response(response):
+            # GFW does not forge soa, verify it over tcp without waiting for timeout, unless right answer picked
+            return picked_responses if strategy in ('pick-right', 'pick-right-later') else []
         if 'pick-first' == strategy:
             return [response]
-        if 'pick-all' != strategy and len(response.an) > 1:
+        if 'pick-all' != strategy and dpkt.dns.DNS_A == record_type and len(response.an) > 1:
             return [response] # GFW does not forge multiple answers
         if 'pick-later' == strategy:
             picked_responses = [response]
-        elif 'pick-right' == strategy:
-            if is_right_response(response, wrong_answers):
+        elif strategy in ('pick-right', 'pick-right-later'):
+            is_right = is_right_response(response, wrong_answers, record_type)
+            if server:
+                UPSTREAM_HEALTH.record_forged(server, not is_right)
+            if not is_right:
+                forged_seen = True
+                WRONG_RESPONSES_REJECTED.inc()
+            elif 'pick-right' == strategy:
                 return [response]
-        elif 'pick-right-later' == strategy:
-            if is_right_response(response, wrong_answers):
+            else:
                 picked_responses = [response]
         elif 'pick-all' == strategy:
             picked_responses.append(response)
         else:
             raise Exception('unsupported strategy: %s' % strategy)
+        if picked_responses and server and domain and POISONING_HISTORY.can_return_early(server, domain):
+            UDP_EARLY_RETURNS.inc()
+            return picked_responses
         remaining_timeout = started_at + timeout - time.time()
     return picked_responses
 
 
-def is_right_response(response, wrong_answers):
-    answers = list_ipv4_addresses(response)
+class PoisoningHistory(object):
+    # learns per upstream and domain suffix whether anything arrives after the first acceptable response,
+    # and which domains get nothing but forged responses over udp
+    def __init__(self, max_entries=10000, alpha=0.125, min_samples=8, probe_every=16, poisoned_seconds=600,
+                 min_poisoned_samples=3):
+        self.max_entries = max_entries
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.probe_every = probe_every # keep waiting fully now and then to notice changes
+        self.poisoned_seconds = poisoned_seconds
+        self.min_poisoned_samples = min_poisoned_samples # one timeout with a forged response is not enough
+        self.entries = collections.OrderedDict() # (server, suffix) => PoisoningStats, least recently used first
+        self.suspected = collections.OrderedDict() # domain => (forged only full waits, since)
+        self.poisoned = collections.OrderedDict() # domain => poisoned until
+
+    def get_stats(self, server, domain):
+        key = (server, get_domain_suffix(domain))
+        stats = self.entries.pop(key, None) or PoisoningStats()
+        self.entries[key] = stats
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return stats
+
+    def record_full_wait(self, server, domain, responses_after_picked):
+        stats = self.get_stats(server, domain)
+        stats.samples += 1
+        stats.late_rate = (1 - self.alpha) * stats.late_rate + (self.alpha if responses_after_picked else 0)
+
+    def can_return_early(self, server, domain):
+        stats = self.get_stats(server, domain)
+        if stats.samples < self.min_samples or stats.late_rate > 0.01:
+            return False
+        stats.early_returns += 1
+        return 0 != stats.early_returns % self.probe_every
+
+    def record_poisoned(self, domain):
+        domain = domain.lower().rstrip('.')
+        now = time.time()
+        count, since = self.suspected.pop(domain, (0, now))
+        if now - since > self.poisoned_seconds:
+            count, since = 0, now
+        count += 1
+        if count < self.min_poisoned_samples:
+            self.suspected[domain] = (count, since)
+            if len(self.suspected) > self.max_entries:
+                self.suspected.popitem(last=False)
+            return
+        LOGGER.info('udp poisoned for %s, use tcp directly for %s seconds' % (domain, self.poisoned_seconds))
+        self.poisoned.pop(domain, None)
+        self.poisoned[domain] = now + self.poisoned_seconds
+        if len(self.poisoned) > self.max_entries:
+            self.poisoned.popitem(last=False)
+
+    def is_poisoned(self, domain):
+        domain = domain.lower().rstrip('.')
+        poisoned_until = self.poisoned.get(domain)
+        if not poisoned_until:
+            return False
+        if time.time() >= poisoned_until:
+            del self.poisoned[domain] # probe udp again
+            return False
+        return True
+
+
+class PoisoningStats(object):
+    def __init__(self):
+        self.samples = 0
+        self.late_rate = 0
+        self.early_returns = 0
+
+
+def get_domain_suffix(domain):
+    # registrable domain, good enough without public suffix list: x.com.hk and x.co.uk are not lumped together
+    labels = domain.lower().rstrip('.').split('.')
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+SECOND_LEVEL_SUFFIXES = {'com', 'net', 'org', 'edu', 'gov', 'co', 'ac', 'or', 'ne', 'go', 'gv', 'idv'}
+
+
+POISONING_HISTORY = PoisoningHistory()
+
+
+def is_right_response(response, wrong_answers, record_type=dpkt.dns.DNS_A):
+    if dpkt.dns.DNS_A != record_type:
+        if not response.an: # GFW forged empty response has no soa
+            return is_negative_response(response)
+        for answer in response.an: # GFW answers other question types with forged A record
+            if answer.type not in (record_type, dpkt.dns.DNS_CNAME, 39) or answer.rdata in wrong_answers:
+                return False
+        return True
+    answers = [answer.rdata for answer in response.an if dpkt.dns.DNS_A == answer.type]
     if not answers: # GFW can forge empty response
         return False
     if len(answers) > 1: # GFW does not forge response with more than one answer
         return True
-    return not any(answer in wrong_answers for answer in answers)
+    return answers[0] not in wrong_answers
+
+
+def is_negative_response(response):
+    # nxdomain or no data, with soa of the zone telling how long to cache it
+    return not response.an and any(dpkt.dns.DNS_SOA == record.type for record in response.ns)
+
+
+def format_answers(answers):
+    # json friendly like dig output, instead of wire format rdata
+    if answers and isinstance(answers[0], list): # pick-all picked more than one response
+        return [format_answers(response_answers) for response_answers in answers]
+    formatted = []
+    for answer, ttl in answers:
+        if isinstance(answer, NegativeAnswer):
+            answer = {'rcode': NEGATIVE_RCODE_NAMES.get(answer.rcode, answer.rcode),
+                      'zone': escape_text(answer.soa_name), 'soa': format_rdata(dpkt.dns.DNS_SOA, answer.soa_rdata)}
+        elif isinstance(answer, tuple):
+            name, record_type, rdata = answer
+            answer = (escape_text(name), RECORD_TYPE_NAMES.get(record_type, record_type),
+                      format_rdata(record_type, rdata))
+        formatted.append((answer, ttl))
+    return formatted
+
+
+def format_rdata(record_type, rdata):
+    try:
+        if dpkt.dns.DNS_A == record_type:
+            return socket.inet_ntoa(rdata)
+        if dpkt.dns.DNS_AAAA == record_type:
+            return socket.inet_ntop(socket.AF_INET6, rdata)
+        if record_type in NAME_RDATA_LAYOUTS:
+            fixed_length, names_count = NAME_RDATA_LAYOUTS[record_type]
+            fields = [str(number) for number in struct.unpack('>%sH' % (fixed_length / 2), rdata[:fixed_length])]
+            offset = fixed_length
+            for i in range(names_count):
+                name, offset = read_name(rdata, offset)
+                fields.append('%s.' % escape_text(name))
+            fields.extend(str(number) for number in struct.unpack('>%sI' % ((len(rdata) - offset) / 4), rdata[offset:]))
+            return ' '.join(fields)
+        if dpkt.dns.DNS_TXT == record_type:
+            strings = []
+            offset = 0
+            while offset < len(rdata):
+                length = ord(rdata[offset])
+                strings.append('"%s"' % escape_text(rdata[offset + 1:offset + 1 + length]))
+                offset += 1 + length
+            return ' '.join(strings)
+    except (struct.error, IndexError, ValueError, socket.error):
+        pass
+    return rdata.encode('hex')
+
+
+def escape_text(text):
+    # bytes outside printable ascii escaped as \DDD like dig, json.dumps fails on them
+    return ''.join(char if ' ' <= char <= '~' and char not in '"\\' else '\\%03d' % ord(char) for char in text)
+
+
+NEGATIVE_RCODE_NAMES = {dpkt.dns.DNS_RCODE_NOERR: 'NODATA', dpkt.dns.DNS_RCODE_NXDOMAIN: 'NXDOMAIN'}
 
 
 def list_ipv4_addresses(response):
-    return [socket.inet_ntoa(answer.rdata) for answer in response.an if dpkt.dns.DNS_A == answer.type]
+    return [(socket.inet_ntoa(answer.rdata), answer.ttl) for answer in response.an if dpkt.dns.DNS_A == answer.type]
+
+
+def list_answers(response, record_type):
+    if dpkt.dns.DNS_A == record_type:
+        answers = list_ipv4_addresses(response)
+    elif dpkt.dns.DNS_AAAA == record_type:
+        answers = [(socket.inet_ntop(socket.AF_INET6, answer.rdata), answer.ttl)
+                   for answer in response.an if dpkt.dns.DNS_AAAA == answer.type]
+    else:
+        answers = [((answer.name, answer.type, answer.rdata), answer.ttl) for answer in response.an]
+    if answers:
+        return answers
+    for record in response.ns: # nxdomain or no data, cached as long as rfc 2308 says
+        if dpkt.dns.DNS_SOA == record.type:
+            minimum, = struct.unpack('>I', record.rdata[-4:])
+            return [(NegativeAnswer(response.rcode, record.name, record.rdata), min(record.ttl, minimum))]
+    return []
 
 
 def discover(domain, at, timeout, repeat, only_new):
     server_ip, server_port = parse_ip_colon_port(at)
-    domains = domain or [
-        'facebook.com', 'youtube.com', 'twitter.com', 'plus.google.com', 'drive.google.com']
+    domains = domain or DISCOVER_DOMAINS
     wrong_answers = set()
     greenlets = []
     for domain in domains:
-        right_answers = resolve_over_tcp(dpkt.dns.DNS_A, domain, server_ip, server_port, timeout * 2)
-        right_answer = right_answers[0] if right_answers else None
+        right_answers = resolve_right_answers(domain, server_ip, server_port, timeout * 2)
         for i in range(repeat):
             greenlets.append(gevent.spawn(
-                discover_one, domain, server_ip, server_port, timeout, right_answer))
+                discover_one, domain, server_ip, server_port, timeout, right_answers))
     for greenlet in greenlets:
         wrong_answers |= greenlet.get()
     if only_new:
@@ -415,20 +2054,267 @@ def discover(domain, at, timeout, repeat, only_new):
         return list(wrong_answers)
 
 
-def discover_one(domain, server_ip, server_port, timeout, right_answer):
+def resolve_right_answers(domain, server_ip, server_port, timeout, lookups=3):
+    # real answer can rotate among many ips, collect them from several lookups
+    right_answers = set()
+    for i in range(lookups):
+        right_answers |= set(answer for answer, ttl in resolve_over_tcp(
+            dpkt.dns.DNS_A, domain, server_ip, server_port, timeout) if not isinstance(answer, NegativeAnswer))
+    return right_answers
+
+
+def discover_one(domain, server_ip, server_port, timeout, right_answers):
+    # forged answer is the single one arriving before the right answer, nothing can be told if it never arrives
     wrong_answers = set()
     responses_answers = resolve_over_udp(
-        dpkt.dns.DNS_A, domain, server_ip, server_port, timeout, 'pick-all', set())
-    contains_right_answer = any(len(answers) > 1 for answers in responses_answers)
-    if right_answer or contains_right_answer:
-        for answers in responses_answers:
-            if len(answers) == 1 and answers[0] != right_answer:
-                wrong_answers |= set(answers)
-    return wrong_answers
+        dpkt.dns.DNS_A, domain, server_ip, server_port, timeout, 'pick-all', set(), learn_poisoning=False)
+    if not responses_answers or not isinstance(responses_answers[0], list): # at most one response
+        return set()
+    for answers in responses_answers:
+        answers = [answer for answer, ttl in answers if not isinstance(answer, NegativeAnswer)]
+        if len(answers) > 1 or set(answers) & right_answers:
+            return wrong_answers
+        wrong_answers |= set(answers)
+    return set()
+
+
+DISCOVER_DOMAINS = ['facebook.com', 'youtube.com', 'twitter.com', 'plus.google.com', 'drive.google.com']
+
+
+class WrongAnswersDiscoverer(object):
+    def __init__(self, server, path, extra_wrong_answers, domains, interval, probing=True, min_sightings=2):
+        self.server = server
+        self.path = path
+        self.extra_wrong_answers = set(extra_wrong_answers) # from --wrong-answer
+        self.domains = domains
+        self.interval = interval
+        self.probing = probing
+        self.min_sightings = min_sightings
+        self.discovered = set()
+        self.suspected = {} # wrong answer => domains it was seen forged for, and times seen
+        self.mtime = None
+
+    def start(self):
+        if self.path:
+            self.load()
+        if self.interval:
+            gevent.spawn(self.run)
+
+    def run(self):
+        for domain in itertools.cycle(self.domains):
+            gevent.sleep(self.interval)
+            try:
+                if self.path and self.get_mtime() != self.mtime:
+                    self.load()
+                if self.probing:
+                    self.probe(domain)
+            except:
+                LOGGER.exception('failed to discover wrong answers')
+
+    def probe(self, domain):
+        server_ip, server_port = random.choice(self.server.upstreams)
+        right_answers = resolve_right_answers(domain, server_ip, server_port, self.server.fallback_timeout * 2)
+        if not right_answers:
+            return
+        new_wrong_answers = set()
+        for wrong_answer in discover_one(domain, server_ip, server_port, self.server.fallback_timeout, right_answers):
+            if socket.inet_aton(wrong_answer) in self.server.wrong_answers:
+                continue
+            if self.is_seen_enough(wrong_answer, domain):
+                new_wrong_answers.add(wrong_answer)
+        if not new_wrong_answers:
+            return
+        LOGGER.error('discovered new wrong answers of %s: %s' % (domain, ', '.join(sorted(new_wrong_answers))))
+        self.discovered |= new_wrong_answers
+        self.apply()
+        self.server.cache.remove_answers(new_wrong_answers)
+        if self.path:
+            self.save()
+
+    def is_seen_enough(self, wrong_answer, domain):
+        # forged answers recur across domains, one sighting might still be a real answer never seen over tcp
+        domains, times = self.suspected.get(wrong_answer, (set(), 0))
+        domains.add(domain)
+        times += 1
+        if len(domains) < min(self.min_sightings, len(set(self.domains))) or times < self.min_sightings:
+            self.suspected[wrong_answer] = (domains, times)
+            return False
+        self.suspected.pop(wrong_answer, None)
+        return True
+
+    def apply(self):
+        self.server.wrong_answers = compile_wrong_answers(self.extra_wrong_answers | self.discovered)
+
+    def load(self):
+        self.mtime = self.get_mtime()
+        if self.mtime is None:
+            return
+        try:
+            with open(self.path) as f:
+                discovered = set(line.split('#')[0].strip() for line in f) - set([''])
+            new_wrong_answers = discovered - self.discovered
+            self.discovered = discovered
+            self.apply()
+            self.server.cache.remove_answers(new_wrong_answers) # cache snapshot is checked when loaded
+            LOGGER.info('loaded %s wrong answers from %s' % (len(self.discovered), self.path))
+        except:
+            LOGGER.exception('failed to load wrong answers from %s, keep using the old ones' % self.path)
+
+    def save(self):
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            f.write(''.join('%s\n' % wrong_answer for wrong_answer in sorted(self.discovered)))
+        os.rename(tmp_path, self.path) # other workers never see half written file
+        self.mtime = self.get_mtime()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+
+def benchmark(strategy, qps, duration, names, zipf, latency, loss, forge_rate, fallback_timeout, cache_size):
+    results = {}
+    for each_strategy in strategy or ['pick-first', 'pick-later', 'pick-right', 'pick-right-later', 'pick-all']:
+        upstream = FakeUpstream(latency, loss, forge_rate)
+        upstream.start()
+        server = DNSServer(('127.0.0.1', 0), [upstream.address], [], set(), 'fqrouter.com', False,
+                           fallback_timeout, each_strategy, DNSCache(cache_size))
+        server.start()
+        try:
+            result = generate_load(server.socket.getsockname(), qps, duration, names, zipf, fallback_timeout * 3)
+        finally:
+            server.stop()
+            upstream.stop()
+        result['upstream_packets_per_query'] = round(upstream.packets / float(result['sent'] or 1), 3)
+        LOGGER.info('%s: %s' % (each_strategy, json.dumps(result, sort_keys=True)))
+        results[each_strategy] = result
+    return results
+
+
+def generate_load(address, qps, duration, names_count, zipf, timeout):
+    names = ['n%s.benchmark.test' % i for i in range(names_count)]
+    requests = [str(dpkt.dns.DNS(id=0, qd=[dpkt.dns.DNS.Q(name=name)])) for name in names]
+    cumulative_weights = []
+    total_weight = 0
+    for i in range(names_count):
+        total_weight += 1.0 / (i + 1) ** zipf
+        cumulative_weights.append(total_weight)
+    sock = gevent.socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    sent_at = {} # transaction id => time
+    latencies = []
+    wrong_answers = [0]
+
+    def receive_forever():
+        while True:
+            data = sock.recv(65535)
+            started_at = sent_at.pop(struct.unpack('>H', data[:2])[0], None)
+            if started_at:
+                latencies.append(time.time() - started_at)
+                if any(address in data for address in BUILTIN_WRONG_ANSWER_SET.addresses):
+                    wrong_answers[0] += 1
+
+    receiver = gevent.spawn(receive_forever)
+    sent = 0
+    started_at = time.time()
+    try:
+        while time.time() - started_at < duration:
+            for i in range(int((time.time() - started_at) * qps) - sent):
+                transaction_id = sent % 65535 + 1
+                index = min(bisect.bisect(cumulative_weights, random.random() * total_weight), names_count - 1)
+                sent_at[transaction_id] = time.time()
+                sock.sendto(struct.pack('>H', transaction_id) + requests[index][2:], address)
+                sent += 1
+            gevent.sleep(0.001)
+        elapsed = time.time() - started_at
+        gevent.sleep(timeout) # wait for late answers
+    finally:
+        receiver.kill()
+        sock.close()
+    latencies.sort()
+    return {
+        'sent': sent,
+        'answered': len(latencies),
+        'wrong_answers': wrong_answers[0],
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'p999_ms': percentile(latencies, 0.999)
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)] * 1000, 3)
+
+
+class FakeUpstream(object):
+    def __init__(self, latency, loss, forge_rate, ttl=300):
+        self.latency = latency
+        self.loss = loss
+        self.forge_rate = forge_rate
+        self.ttl = ttl
+        self.packets = 0
+        self.address = None
+        self.udp_server = gevent.server.DatagramServer(('127.0.0.1', 0), self.handle_udp)
+        self.tcp_server = None
+        self.wrong_answers = sorted(BUILTIN_WRONG_ANSWERS())
+
+    def start(self):
+        self.udp_server.start()
+        self.address = self.udp_server.socket.getsockname()
+        self.tcp_server = gevent.server.StreamServer(self.address, self.handle_tcp)
+        self.tcp_server.start()
+
+    def stop(self):
+        self.udp_server.stop()
+        self.tcp_server.stop()
+
+    def handle_udp(self, data, address):
+        self.packets += 1
+        request = dpkt.dns.DNS(data)
+        if self.is_forged(request.qd[0].name): # GFW is closer than upstream, forged answer always comes first
+            self.udp_server.sendto(self.answer(request, socket.inet_aton(random.choice(self.wrong_answers))), address)
+        if random.random() < self.loss:
+            return
+        gevent.sleep(self.latency)
+        self.udp_server.sendto(self.answer(request, self.get_right_answer(request.qd[0].name)), address)
+
+    def handle_tcp(self, sock, address):
+        lock = gevent.lock.Semaphore()
+
+        def reply(request):
+            gevent.sleep(self.latency)
+            data = self.answer(request, self.get_right_answer(request.qd[0].name))
+            with lock:
+                sock.sendall(struct.pack('>H', len(data)) + data)
+
+        try:
+            while True:
+                data = recv_exactly(sock, struct.unpack('>H', recv_exactly(sock, 2))[0])
+                self.packets += 1
+                gevent.spawn(reply, dpkt.dns.DNS(data))
+        except socket.error:
+            pass
+
+    def is_forged(self, domain):
+        return (hash(domain) % 1000) < self.forge_rate * 1000
+
+    def get_right_answer(self, domain):
+        return struct.pack('>I', 0x0a000000 | (hash(domain) & 0xffffff)) # 10.x.x.x, never a wrong answer
+
+    def answer(self, request, rdata):
+        response = dpkt.dns.DNS(str(request))
+        response.qr = dpkt.dns.DNS_R
+        response.an = [dpkt.dns.DNS.RR(
+            name=request.qd[0].name, type=dpkt.dns.DNS_A, ttl=self.ttl, rlen=len(rdata), rdata=rdata)]
+        return str(response)
 
 
 def create_socket(*args, **kwargs):
-    sock = socket.socket(*args, **kwargs)
+    sock = gevent.socket.socket(*args, **kwargs) # cooperative even without monkey patching
     if OUTBOUND_MARK:
         sock.setsockopt(socket.SOL_SOCKET, SO_MARK, OUTBOUND_MARK)
     if OUTBOUND_IP:
@@ -440,6 +2326,10 @@ class SocketTimeout(BaseException):
     pass
 
 
+class ConnectionClosed(socket.error):
+    pass
+
+
 def BUILTIN_WRONG_ANSWERS():
     return {
         '4.36.66.178',
@@ -486,6 +2376,55 @@ def BUILTIN_WRONG_ANSWERS():
     }
 
 
+class WrongAnswers(object):
+    def __init__(self, wrong_answers=()):
+        addresses = set()
+        networks = []
+        ipv6_networks = []
+        for wrong_answer in wrong_answers:
+            if '/' in wrong_answer and ':' in wrong_answer:
+                ip, prefix_length = wrong_answer.split('/')
+                mask = ((1 << 128) - 1) ^ ((1 << (128 - int(prefix_length))) - 1)
+                ipv6_networks.append((int(socket.inet_pton(socket.AF_INET6, ip).encode('hex'), 16) & mask, mask))
+            elif '/' in wrong_answer:
+                ip, prefix_length = wrong_answer.split('/')
+                mask = (0xffffffff << (32 - int(prefix_length))) & 0xffffffff
+                networks.append((struct.unpack('>I', socket.inet_aton(ip))[0] & mask, mask))
+            elif ':' in wrong_answer:
+                addresses.add(socket.inet_pton(socket.AF_INET6, wrong_answer))
+            else:
+                addresses.add(socket.inet_aton(wrong_answer))
+        self.addresses = frozenset(addresses) # packed 4 or 16 bytes, compared against rdata directly
+        self.networks = tuple(networks)
+        self.ipv6_networks = tuple(ipv6_networks)
+
+    def __contains__(self, rdata):
+        if rdata in self.addresses:
+            return True
+        if self.networks and 4 == len(rdata):
+            ip, = struct.unpack('>I', rdata)
+            for network, mask in self.networks:
+                if ip & mask == network:
+                    return True
+        if self.ipv6_networks and 16 == len(rdata):
+            ip = int(rdata.encode('hex'), 16)
+            for network, mask in self.ipv6_networks:
+                if ip & mask == network:
+                    return True
+        return False
+
+
+BUILTIN_WRONG_ANSWER_SET = WrongAnswers(BUILTIN_WRONG_ANSWERS())
+
+
+def compile_wrong_answers(wrong_answer):
+    if isinstance(wrong_answer, WrongAnswers):
+        return wrong_answer
+    if wrong_answer:
+        return WrongAnswers(BUILTIN_WRONG_ANSWERS() | set(wrong_answer))
+    return BUILTIN_WRONG_ANSWER_SET
+
+
 CHINA_DOMAINS = [
     '07073.com',
     '10010.com',
@@ -946,13 +2885,109 @@ CHINA_DOMAINS = [
 ]
 
 
+class DomainSuffixIndex(object):
+    def __init__(self, domains=()):
+        self.suffixes = set()
+        self.wildcards = {} # parent domain => [pattern of first label], cctv*.com => {'com': [cctv*]}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        domain = domain.strip().strip('.').lower()
+        label, _, parent = domain.partition('.')
+        if '*' in label or '?' in label:
+            self.wildcards.setdefault(parent, []).append(re.compile(fnmatch.translate(label)))
+        elif domain:
+            self.suffixes.add(domain)
+
+    def __contains__(self, domain):
+        suffix = domain.rstrip('.').lower()
+        while True:
+            if suffix in self.suffixes:
+                return True
+            if self.wildcards:
+                label, _, parent = suffix.partition('.')
+                for pattern in self.wildcards.get(parent, ()):
+                    if pattern.match(label):
+                        return True
+            dot = suffix.find('.')
+            if dot < 0:
+                return False
+            suffix = suffix[dot + 1:]
+
+
+CHINA_DOMAIN_INDEX = DomainSuffixIndex(CHINA_DOMAINS + ['cn'])
+
+
 def is_china_domain(domain):
-    if domain.endswith('.cn'):
-        return True
-    for chain_domain in CHINA_DOMAINS:
-        if domain == chain_domain or domain.endswith('.%s' % chain_domain):
-            return True
-    return False
+    return domain in CHINA_DOMAIN_INDEX
+
+
+class DomainFilesReloader(object):
+    def __init__(self, server, china_domain_files, hosted_domain_files, hosted_domains=(),
+                 interval=DOMAIN_FILES_CHECK_INTERVAL):
+        self.server = server
+        self.china_domain_files = china_domain_files
+        self.hosted_domain_files = hosted_domain_files
+        self.hosted_domains = hosted_domains # from --hosted-domain, kept across reloads
+        self.interval = interval
+        self.mtimes = {}
+        self.lock = gevent.lock.Semaphore()
+
+    def start(self):
+        self.reload()
+        handle_signal(signal.SIGHUP, lambda: gevent.spawn(self.reload))
+        gevent.spawn(self.watch)
+
+    def watch(self):
+        while True:
+            gevent.sleep(self.interval)
+            if self.get_mtimes() != self.mtimes:
+                self.reload()
+
+    def reload(self):
+        with self.lock:
+            self.mtimes = self.get_mtimes()
+            try:
+                if self.china_domain_files:
+                    self.server.china_domains = load_domain_files(self.china_domain_files, DomainSuffixIndex())
+                if self.hosted_domain_files:
+                    self.server.hosted_domains = load_domain_files(self.hosted_domain_files, set(self.hosted_domains))
+            except:
+                LOGGER.exception('failed to reload domain files, keep using the old ones')
+
+    def get_mtimes(self):
+        mtimes = {}
+        for path in self.china_domain_files + self.hosted_domain_files:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+
+def load_domain_files(paths, domains):
+    started_at = time.time()
+    count = 0
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                domain = parse_domain_line(line)
+                if not domain:
+                    continue
+                domains.add(domain)
+                count += 1
+                if 0 == count % 2000:
+                    gevent.sleep(0.001) # keep serving queries while loading huge list, sleep(0) does not poll sockets
+    LOGGER.info('loaded %s domains from %s in %.3f seconds', count, ', '.join(paths), time.time() - started_at)
+    return domains
+
+
+def parse_domain_line(line):
+    line = line.split('#', 1)[0].strip()
+    if '=/' in line: # dnsmasq server=/a.com/114.114.114.114
+        line = line.split('/')[1]
+    return line.strip('.').lower()
 
 
 def HOSTED_DOMAINS():
@@ -970,10 +3005,6 @@ def HOSTED_DOMAINS():
         'google.cn', 'www.google.cn'
     }
 
-# TODO cache
-# TODO PTR support, check cache then check remote
-# TODO IPV6
-# TODO complete record types
 # TODO --recursive
 
 if '__main__' == __name__: